@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from array import array
+from itertools import accumulate
+
+from server import P2WServer, WinnerStore
+
+# Board sizes and online player counts used when none are given on the command line
+DEFAULT_SIZES = [1000, 100000, 1000000]
+DEFAULT_PLAYERS = [100, 10000]
+RESULTS_FILE = "benchmarks.jsonl"
+
+
+def git_commit():
+    """Short hash of HEAD, with a + suffix when the working tree has changes"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=here,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=here,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def populate(server, size):
+    """Fill the server with size synthetic winners, much faster than appending one by one"""
+    store = WinnerStore()
+    now = int(time.time())
+    for start in range(0, size, 100000):
+        names = [f"player{i}".encode('utf-8') for i in range(start, min(start + 100000, size))]
+        offset = len(store.name_tail)
+        store.name_tail += b"".join(names)
+        # Columns are filled directly and indexed once, like extend_legacy does
+        store.name_ends.tail.extend(array('Q', (offset + end for end in accumulate(len(name) for name in names))))
+        store.timestamps.tail.extend(array('q', [now]) * len(names))
+        store.latencies.tail.extend(array('f', (random.uniform(10, 100) for _ in names)))
+        store.ips.tail.extend(array('Q', (0x0A000000 + i % 65536 for i in range(start, start + len(names)))))
+    store.rebuild_indexes()
+    server.winners = store
+    server.page_cache.clear()
+    server.stats_cache = None
+
+
+def add_players(server, players):
+    now = time.time()
+    with server.players_lock:
+        server.connected_players.clear()
+        for i in range(players):
+            server.touch_player(f"online{i}", now)
+
+
+def measure(fn, iterations, repeat):
+    """Best of repeat runs, in nanoseconds per call"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for i in range(iterations):
+            fn(i)
+        elapsed = (time.perf_counter_ns() - start) / iterations
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def benchmarks(server, size):
+    """(name, fn(i), iterations) for every hot path, fn gets the iteration number"""
+    run_id = random.randrange(1 << 30)
+    page_size = server.config['leaderboard_page_size']
+    deep_pages = max(1, size // page_size)
+    respond = server.respond
+
+    def uncached_page(i):
+        server.page_cache.clear()
+        respond(f"GET_LEADERBOARD:{(i * 7919) % deep_pages * page_size}:{page_size}", "10.1.0.1")
+
+    def uncached_stats(i):
+        server.stats_cache = None
+        respond("GET_STATS", "10.1.0.1")
+
+    def win(i):
+        respond(f"P2W_PING:b{run_id}_{i}|12.5", "10.2.0.1")
+
+    def save_path(i):
+        for n in range(100):
+            server.save_winners({'username': f"s{i}_{n}", 'timestamp': "2025-01-01 00:00:00",
+                                 'ip': "10.3.0.1", 'rank': size + n, 'latency': "12.00ms"})
+        server.flush_journal()
+
+    def leaderboard_json(i):
+        start = (i * 7919) % deep_pages * page_size
+        json.dumps(server.winners.slice(start, start + page_size))
+
+    return [
+        ("validate_username", lambda i: server.validate_username(f"player{i}"), 100000),
+        ("check_rate_limit", lambda i: server.check_rate_limit(f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"), 100000),
+        ("duplicate_check_hit", lambda i: f"player{i % size}" in server.winners, 100000),
+        ("duplicate_check_miss", lambda i: f"nobody{i}" in server.winners, 100000),
+        ("GET_STATS_cached", lambda i: respond("GET_STATS", "10.1.0.1"), 100000),
+        ("GET_STATS_uncached", uncached_stats, 20000),
+        ("GET_LEADERBOARD_cached", lambda i: respond("GET_LEADERBOARD", "10.1.0.1"), 20000),
+        ("GET_LEADERBOARD_uncached", uncached_page, 500),
+        ("GET_LEADERBOARD_USER", lambda i: respond(f"GET_LEADERBOARD_USER:player{(i * 7919) % size}", "10.1.0.1"), 20000),
+        ("leaderboard_json_dumps", leaderboard_json, 500),
+        ("HEARTBEAT", lambda i: respond(f"HEARTBEAT:online{i % 100}", "10.1.0.1"), 100000),
+        ("P2W_PING_win", win, 20000),
+        ("save_path_100_wins", save_path, 50),
+    ]
+
+
+def run(sizes, player_counts, repeat, scale, only, results_file):
+    commit = git_commit()
+    workdir = tempfile.mkdtemp(prefix="p2w_bench_")
+    cwd = os.getcwd()
+    results_file = os.path.abspath(results_file)
+    records = []
+    print(f"Benchmarking commit {commit} in {workdir}")
+    os.chdir(workdir)
+    try:
+        for size in sizes:
+            # No sockets and no background threads, the journal lands in the temp dir
+            server = P2WServer(port=5555, start_threads=False)
+            server.config['rate_limit_enabled'] = False
+            start = time.perf_counter()
+            populate(server, size)
+            print(f"\n{size:,} winners (built in {time.perf_counter() - start:.1f}s)")
+
+            for players in player_counts:
+                add_players(server, players)
+                print(f"  {players:,} players online")
+                for name, fn, iterations in benchmarks(server, size):
+                    if only and name not in only:
+                        continue
+                    iterations = max(1, int(iterations * scale))
+                    ns = measure(fn, iterations, repeat)
+                    print(f"    {name:<28}{ns / 1000:>12.2f} us/op")
+                    records.append({
+                        'commit': commit, 'timestamp': int(time.time()), 'python': platform.python_version(),
+                        'platform': platform.platform(), 'benchmark': name, 'board_size': size, 'players': players,
+                        'iterations': iterations, 'repeat': repeat, 'ns_per_op': round(ns, 1)
+                    })
+            if server.journal:
+                server.journal.close()
+                os.remove(server.journal_file)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(results_file, 'a') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    print(f"\n{len(records)} results appended to {results_file}")
+
+
+def load_runs(results_file):
+    """{commit: {(benchmark, board_size, players): ns_per_op}}, a later run of the same commit wins"""
+    runs = {}
+    with open(results_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                key = (record['benchmark'], record['board_size'], record['players'])
+                runs.setdefault(record['commit'], {})[key] = record['ns_per_op']
+    return runs
+
+
+def compare(results_file, base, head, threshold):
+    """Print head vs base per benchmark, returns False when anything regressed past threshold percent"""
+    runs = load_runs(results_file)
+    commits = list(runs)
+    head = head or commits[-1]
+    for commit in (base, head):
+        if commit not in runs:
+            print(f"No results for {commit} in {results_file} (have: {', '.join(commits)})")
+            return False
+
+    print(f"{'Benchmark':<28}{'Board':>10}{'Players':>9}{base:>12}{head:>12}{'Change':>9}")
+    regressed = False
+    for key in sorted(set(runs[base]) & set(runs[head])):
+        before, after = runs[base][key], runs[head][key]
+        change = (after - before) / before * 100 if before else 0
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressed = True
+        benchmark, size, players = key
+        print(f"{benchmark:<28}{size:>10}{players:>9}{before / 1000:>10.2f}us{after / 1000:>10.2f}us{change:>+8.1f}%{flag}")
+    return not regressed
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="In-process benchmarks of the P2W server hot paths")
+    parser.add_argument('--sizes', default=",".join(map(str, DEFAULT_SIZES)), help="comma-separated board sizes, e.g. 1000,10000000")
+    parser.add_argument('--players', default=",".join(map(str, DEFAULT_PLAYERS)), help="comma-separated online player counts")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the best one counts")
+    parser.add_argument('--scale', type=float, default=1.0, help="multiply iteration counts (0.1 for a quick run)")
+    parser.add_argument('--only', help="comma-separated benchmark names")
+    parser.add_argument('--results', default=RESULTS_FILE, help="JSON lines file results are appended to")
+    parser.add_argument('--compare', nargs='+', metavar='COMMIT', help="compare BASE [HEAD] from the results file instead of running")
+    parser.add_argument('--threshold', type=float, default=10.0, help="percent slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        ok = compare(args.results, args.compare[0], args.compare[1] if len(args.compare) > 1 else None, args.threshold)
+        return 0 if ok else 1
+
+    run([int(s) for s in args.sizes.split(",")], [int(p) for p in args.players.split(",")],
+        args.repeat, args.scale, set(args.only.split(",")) if args.only else None, args.results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -4,7 +4,504 @@ import socket
 import json
 import time
 import threading
-import os
+import queue
+import select
+import statistics
+from collections import OrderedDict
+from protocol import StreamConnection, ProtocolError, StreamBusy
+
+# Commands that must not be sent twice once the server may have seen them
+UNREPEATABLE_COMMANDS = ("P2W_PING:",)
+STREAM_BUSY_RETRY_SECONDS = 30
+
+def oneshot_request(host, port, message, timeout=5):
+    """Classic request on its own connection, read until the server closes it"""
+    try:
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect((host, int(port)))
+        client.send(message.encode('utf-8'))
+        
+        # Read ALL data until connection closes
+        response_data = b''
+        while True:
+            chunk = client.recv(4096)
+            if not chunk:
+                break
+            response_data += chunk
+        
+        client.close()
+        return response_data.decode('utf-8', errors='ignore')
+    except socket.timeout:
+        return "TIMEOUT"
+    except ConnectionRefusedError:
+        return "REFUSED"
+    except socket.gaierror:
+        return "DNS_ERROR"
+    except Exception as e:
+        return f"ERROR:{str(e)}"
+
+def connect_latency(host, port, timeout=2):
+    """TCP connect time in ms, the latency estimate for servers without persistent connections"""
+    try:
+        start = time.perf_counter_ns()
+        client = socket.create_connection((host, int(port)), timeout=timeout)
+        latency = (time.perf_counter_ns() - start) / 1e6
+        client.close()
+        return latency
+    except OSError:
+        return None
+
+def rtt_summary(samples):
+    """{'min', 'median', 'jitter', 'samples'} in ms, jitter is the mean change between consecutive samples"""
+    if not samples:
+        return None
+    jitter = statistics.mean(abs(b - a) for a, b in zip(samples, samples[1:])) if len(samples) > 1 else 0.0
+    return {'min': min(samples), 'median': statistics.median(samples), 'jitter': jitter, 'samples': len(samples)}
+
+class ServerLink:
+    """One persistent connection to a server, owned by a single I/O thread.
+    
+    Requests are queued from the UI thread and whatever is queued together
+    is pipelined in one round trip. Periodic requests (stats, heartbeats)
+    are scheduled by the I/O loop itself. Callbacks are not run on the I/O
+    thread, they are handed back through results for the UI thread to
+    drain, so no widget is touched from another thread. Servers without
+    persistent connections get one-shot requests instead.
+    
+    After subscribe() the server pushes frames on its own. Between requests
+    the loop waits on the socket as well as the job queue, so pushes are
+    picked up as they arrive.
+    """
+    
+    def __init__(self, host, port, timeout=5):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        # [due, interval, message, callback, timeout], only touched by the I/O thread
+        self.periodic = []
+        self.stream = None
+        self.stream_supported = True
+        # A busy server is asked again for a persistent connection after this
+        self.stream_retry_at = 0
+        # Push handler and the SUBSCRIBE to repeat when the connection is reopened
+        self.on_push = None
+        self.resubscribe = None
+        # Queued jobs also write a byte here so select() wakes up for them
+        self.wake_r, self.wake_w = socket.socketpair()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def start(self):
+        self.thread.start()
+        return self
+    
+    def put(self, job):
+        self.jobs.put(job)
+        try:
+            self.wake_w.send(b"\0")
+        except OSError:
+            pass
+    
+    def request(self, message, callback=None, timeout=None):
+        """Queue a request, callback(response) runs on the UI thread"""
+        self.put(("request", message, callback, timeout or self.timeout))
+    
+    def probe(self, callback, samples=5, timeout=2):
+        """Measure round trips, callback gets an rtt_summary() dict or None when nothing got through"""
+        self.put(("probe", samples, callback, timeout))
+    
+    def every(self, interval, message, callback, timeout=None):
+        """Send message now and then every interval seconds until the link is closed"""
+        self.put(("every", message, callback, timeout or self.timeout, interval))
+    
+    def subscribe(self, on_push, callback=None, since=None):
+        """Ask for server pushes, on_push(payload) runs on the UI thread for each one.
+        
+        callback gets the SUBSCRIBE reply, anything but SUBSCRIBED means the
+        server can't push and the caller should poll instead.
+        """
+        message = "SUBSCRIBE" if since is None else f"SUBSCRIBE:{since}"
+        self.put(("subscribe", message, callback, self.timeout, on_push))
+    
+    def unsubscribe(self, callback=None):
+        """Stop server pushes, also on a reopened connection"""
+        self.put(("subscribe", "UNSUBSCRIBE", callback, self.timeout, None))
+    
+    def close(self, message=None, wait=1.0):
+        """Stop the I/O thread after sending a last message (e.g. DISCONNECT)"""
+        self.put(("close", message, None, 2))
+        if wait and self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join(wait)
+    
+    def dispatch(self):
+        """Run callbacks of finished requests, call this from the UI thread"""
+        while True:
+            try:
+                callback, value = self.results.get_nowait()
+            except queue.Empty:
+                return
+            callback(value)
+    
+    def run(self):
+        while True:
+            now = time.monotonic()
+            wait = min((entry[0] for entry in self.periodic), default=now + 60) - now
+            self.wait(max(0, wait))
+            jobs = []
+            try:
+                while True:
+                    jobs.append(self.jobs.get_nowait())
+            except queue.Empty:
+                pass
+            
+            batch = []
+            closing = None
+            now = time.monotonic()
+            for job in jobs:
+                kind = job[0]
+                if closing:
+                    break
+                if kind == "request":
+                    batch.append(job[1:])
+                elif kind == "probe":
+                    # Requests queued before the probe go first, the probe gets a round trip of its own
+                    self.send_batch(batch)
+                    batch = []
+                    self.finish(job[2], self.measure(job[1], job[3]))
+                elif kind == "subscribe":
+                    # Sent on its own so a SUBSCRIBED reply can be remembered for reconnects
+                    self.send_batch(batch)
+                    batch = []
+                    self.on_push = job[4]
+                    response = self.exchange([job[1]], job[3])[0]
+                    self.resubscribe = job[1] if response == "SUBSCRIBED" else None
+                    self.finish(job[2], response)
+                elif kind == "every":
+                    _, message, callback, timeout, interval = job
+                    self.periodic.append([now + interval, interval, message, callback, timeout])
+                    batch.append((message, callback, timeout))
+                elif kind == "close":
+                    closing = job
+            for entry in self.periodic:
+                if entry[0] <= now:
+                    entry[0] = now + entry[1]
+                    batch.append((entry[2], entry[3], entry[4]))
+            
+            self.send_batch(batch)
+            if closing:
+                if closing[1]:
+                    self.exchange([closing[1]], closing[3])
+                self.drop_stream()
+                self.wake_r.close()
+                self.wake_w.close()
+                return
+    
+    def wait(self, timeout):
+        """Sleep until a job is queued, a push arrives or timeout passes"""
+        sockets = [self.wake_r]
+        if self.stream and self.on_push:
+            sockets.append(self.stream.sock)
+        readable, _, _ = select.select(sockets, [], [], timeout)
+        if self.wake_r in readable:
+            self.wake_r.recv(4096)
+        if self.stream and self.stream.sock in readable:
+            try:
+                self.stream.read_pushes()
+            except (OSError, ProtocolError):
+                # Reopened, and resubscribed, by the next request
+                self.drop_stream()
+    
+    def push(self, payload):
+        self.finish(self.on_push, payload)
+    
+    def send_batch(self, batch):
+        """Pipeline (message, callback, timeout) requests in one round trip"""
+        if batch:
+            responses = self.exchange([message for message, _, _ in batch], max(timeout for _, _, timeout in batch))
+            for (_, callback, _), response in zip(batch, responses):
+                self.finish(callback, response)
+    
+    def finish(self, callback, value):
+        if callback:
+            self.results.put((callback, value))
+    
+    def open_stream(self, timeout):
+        """True when the persistent connection is usable, connecting it if needed"""
+        if self.stream is not None:
+            try:
+                self.check_stream()
+            except (OSError, ProtocolError):
+                self.drop_stream()
+        if self.stream is None and self.stream_supported and time.monotonic() >= self.stream_retry_at:
+            try:
+                self.stream = StreamConnection(self.host, self.port, timeout, self.push)
+                self.stream.connect()
+                if self.resubscribe:
+                    self.stream.request(self.resubscribe)
+            except StreamBusy:
+                # Out of persistent sessions for now, one-shot requests until the retry
+                self.drop_stream()
+                self.stream_retry_at = time.monotonic() + STREAM_BUSY_RETRY_SECONDS
+            except ProtocolError:
+                # Old server without persistent connections
+                self.drop_stream()
+                self.stream_supported = False
+            except OSError:
+                self.drop_stream()
+        return self.stream is not None
+    
+    def check_stream(self):
+        """Notice a connection the server already closed before writing anything to it"""
+        readable, _, _ = select.select([self.stream.sock], [], [], 0)
+        if readable:
+            self.stream.read_pushes()
+    
+    def drop_stream(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+    
+    def exchange(self, messages, timeout):
+        """Pipeline messages over the persistent connection, one-shot requests if that fails.
+        
+        When the connection breaks partway, replies already read are kept
+        and only the rest is retried. A P2W_PING without a reply may still
+        have been applied, repeating it would answer ALREADY_WON, so it
+        gets an error instead and the caller looks the result up.
+        """
+        if self.open_stream(timeout):
+            replies = []
+            try:
+                self.stream.sock.settimeout(timeout)
+                self.stream.send(messages)
+                while len(replies) < len(messages):
+                    replies.append(self.stream.recv_frame())
+                return replies
+            except socket.timeout:
+                self.drop_stream()
+                return replies + ["TIMEOUT"] * (len(messages) - len(replies))
+            except (OSError, ProtocolError):
+                self.drop_stream()
+            return replies + [self.retry(message, timeout) for message in messages[len(replies):]]
+        return [oneshot_request(self.host, self.port, message, timeout) for message in messages]
+    
+    def retry(self, message, timeout):
+        if message.startswith(UNREPEATABLE_COMMANDS):
+            return "ERROR:connection lost"
+        return oneshot_request(self.host, self.port, message, timeout)
+    
+    def measure(self, count, timeout):
+        """count back-to-back RTT_PROBEs, each echoing the token of the previous RTT_ACK.
+        
+        The echoes let the server take its own samples of the same round
+        trips. Servers without RTT_PROBE reject it, the rejection is still
+        a round trip. Without a persistent connection, connects are timed.
+        """
+        if not self.open_stream(timeout):
+            samples = [connect_latency(self.host, self.port, timeout) for _ in range(count)]
+            return rtt_summary([sample for sample in samples if sample is not None])
+        samples = []
+        token = ""
+        try:
+            self.stream.sock.settimeout(timeout)
+            for _ in range(count):
+                start = time.perf_counter_ns()
+                reply = self.stream.request(f"RTT_PROBE:{token}" if token else "RTT_PROBE")
+                samples.append((time.perf_counter_ns() - start) / 1e6)
+                token = reply.split(":")[1] if reply.startswith("RTT_ACK:") else ""
+        except (OSError, ProtocolError):
+            self.drop_stream()
+        return rtt_summary(samples)
+
+class LeaderboardView:
+    """Windowed leaderboard, the Treeview only ever holds the rows on screen.
+    
+    The scrollbar is driven by hand over the whole board and rows are
+    filled from an LRU cache of pages. Pages missing from the cache are
+    fetched in the background once scrolling pauses, placeholders stand
+    in until they arrive. Ranks never move, so full pages stay valid and
+    a refresh only drops the partial page at the end of the board.
+    """
+    
+    COLUMNS = (("Rank", 80), ("Username", 150), ("Time", 180), ("Latency", 100))
+    
+    def __init__(self, parent, fetch_page, page_size=100, max_pages=256):
+        # fetch_page(offset, limit, callback), callback gets a page dict or an error string
+        self.fetch_page = fetch_page
+        self.page_size = page_size
+        self.max_pages = max_pages
+        self.pages = OrderedDict()
+        self.pending = set()
+        self.total = None
+        self.error = None
+        self.top = 0
+        self.visible = 20
+        self.items = []
+        self.fetch_job = None
+        # Called when total or error changes
+        self.on_change = None
+        
+        frame = tk.Frame(parent)
+        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        
+        self.scrollbar = ttk.Scrollbar(frame, command=self.on_scrollbar)
+        self.scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        
+        self.tree = ttk.Treeview(frame, columns=[name for name, _ in self.COLUMNS], show="headings", selectmode="none")
+        for name, width in self.COLUMNS:
+            self.tree.heading(name, text=name)
+            self.tree.column(name, width=width, anchor="center")
+        self.tree.pack(fill=tk.BOTH, expand=True)
+        
+        try:
+            self.row_height = int(ttk.Style().lookup("Treeview", "rowheight"))
+        except (ValueError, tk.TclError):
+            self.row_height = 20
+        
+        self.tree.bind("<Configure>", self.on_resize)
+        self.tree.bind("<MouseWheel>", self.on_wheel)
+        self.tree.bind("<Button-4>", self.on_wheel)
+        self.tree.bind("<Button-5>", self.on_wheel)
+        self.tree.bind("<Button-1>", lambda e: self.tree.focus_set())
+        for key, step in (("<Up>", -1), ("<Down>", 1)):
+            self.tree.bind(key, lambda e, step=step: self.scroll_by(step))
+        for key, pages in (("<Prior>", -1), ("<Next>", 1)):
+            self.tree.bind(key, lambda e, pages=pages: self.scroll_by(pages * self.visible))
+        self.tree.bind("<Home>", lambda e: self.scroll_to(0) or "break")
+        self.tree.bind("<End>", lambda e: self.scroll_to(self.total or 0) or "break")
+    
+    def exists(self):
+        try:
+            return bool(self.tree.winfo_exists())
+        except tk.TclError:
+            return False
+    
+    def scroll_to(self, top):
+        last_top = max(0, (self.total or 0) - self.visible)
+        self.top = max(0, min(int(top), last_top))
+        self.render()
+        self.schedule_fetch()
+    
+    def scroll_by(self, rows):
+        self.scroll_to(self.top + rows)
+        return "break"
+    
+    def on_scrollbar(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(float(amount) * (self.total or 0))
+        elif action == "scroll":
+            self.scroll_by(int(amount) * (self.visible if unit == "pages" else 1))
+    
+    def on_wheel(self, event):
+        # X11 sends buttons 4/5, Windows and macOS a signed delta
+        up = event.num == 4 or getattr(event, 'delta', 0) > 0
+        return self.scroll_by(-3 if up else 3)
+    
+    def on_resize(self, event):
+        # One row's worth of height goes to the headings
+        visible = max(1, event.height // self.row_height - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self.scroll_to(self.top)
+    
+    def render(self):
+        """Point the on-screen rows at top..top+visible, only these few items ever exist"""
+        count = max(0, min(self.visible, (self.total or 0) - self.top))
+        while len(self.items) < count:
+            self.items.append(self.tree.insert("", tk.END))
+        while len(self.items) > count:
+            self.tree.delete(self.items.pop())
+        
+        for i, item in enumerate(self.items):
+            index = self.top + i
+            offset = index - index % self.page_size
+            page = self.pages.get(offset)
+            if page is not None and index - offset < len(page):
+                self.pages.move_to_end(offset)
+                winner = page[index - offset]
+                values = (f"#{winner['rank']}", winner['username'], winner['timestamp'], winner.get('latency', 'N/A'))
+            else:
+                values = (f"#{index + 1}", "...", "", "")
+            self.tree.item(item, values=values)
+        
+        if self.total:
+            self.scrollbar.set(self.top / self.total, (self.top + count) / self.total)
+        else:
+            self.scrollbar.set(0, 1)
+    
+    def schedule_fetch(self, delay=50):
+        """Fetch what's on screen once scrolling settles, dragging the scrollbar shouldn't load every page it passes"""
+        if self.fetch_job:
+            self.tree.after_cancel(self.fetch_job)
+        self.fetch_job = self.tree.after(delay, self.fetch_visible)
+    
+    def fetch_visible(self):
+        self.fetch_job = None
+        if self.total is None:
+            return
+        # The page after the screen is prefetched so scrolling down rarely shows placeholders
+        first = self.top - self.top % self.page_size
+        last = min(self.top + self.visible + self.page_size, self.total)
+        for offset in range(first, last, self.page_size):
+            if offset not in self.pages:
+                self.request(offset)
+    
+    def request(self, offset):
+        if offset in self.pending:
+            return
+        self.pending.add(offset)
+        self.fetch_page(offset, self.page_size, lambda page: self.on_page(offset, page))
+    
+    def on_page(self, offset, page):
+        self.pending.discard(offset)
+        if not self.exists():
+            return
+        if isinstance(page, str):
+            self.set_state(self.total, page)
+            return
+        
+        winners = page.get('winners', [])
+        total = page.get('total', offset + len(winners))
+        if winners and len(winners) < self.page_size and offset + len(winners) < total:
+            # The server's pages are smaller than ours, continue with its size
+            self.page_size = len(winners)
+            self.pages.clear()
+        if offset % self.page_size:
+            return
+        
+        self.pages[offset] = winners
+        self.pages.move_to_end(offset)
+        while len(self.pages) > self.max_pages:
+            self.pages.popitem(last=False)
+        self.set_state(total, None)
+        self.render()
+        self.schedule_fetch()
+    
+    def set_state(self, total, error):
+        if (total, error) != (self.total, self.error):
+            self.total, self.error = total, error
+            if self.on_change:
+                self.on_change()
+    
+    def refresh(self):
+        """Reload in place, full pages can't have changed so only partial ones are dropped"""
+        for offset in [offset for offset, rows in self.pages.items() if len(rows) < self.page_size]:
+            del self.pages[offset]
+        # Always asked for, so the total is current even when the screen is fully cached
+        self.request(self.top - self.top % self.page_size)
+        self.schedule_fetch(0)
+    
+    def add_winners(self, offset, winners, total):
+        """Winners pushed by the server, appended to cached pages they continue"""
+        for index, winner in enumerate(winners, offset):
+            page = self.pages.get(index - index % self.page_size)
+            if page is not None and len(page) == index % self.page_size:
+                page.append(winner)
+        self.set_state(max(total, self.total or 0), self.error)
+        self.render()
+        self.schedule_fetch()
 
 class P2WClient:
     def __init__(self):
@@ -20,10 +517,15 @@ class P2WClient:
         self.is_connected = False
         self.stats = {}
         self.config_file = "p2w_config.json"
-        self.stats_thread = None
-        self.heartbeat_thread = None
         self.connection_status = "disconnected"
         
+        # All networking goes through the link's I/O thread, results come back via poll_link
+        self.link = None
+        self.connecting = False
+        self.ping_pending = False
+        # Open leaderboard windows, called with every pushed page of new winners
+        self.winner_listeners = []
+        
         self.load_config()
         self.setup_shortcuts()
         self.show_connection_screen()
@@ -67,73 +569,62 @@ class P2WClient:
         if self.is_connected and not self.has_pinged:
             self.ping_server()
     
-    def send_request(self, message, timeout=5):
-        """Helper to send requests to server with proper error handling"""
-        try:
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client.settimeout(timeout)
-            client.connect((self.server_ip, int(self.server_port)))
-            client.send(message.encode('utf-8'))
-            
-            # Read ALL data until connection closes
-            response_data = b''
-            while True:
-                chunk = client.recv(4096)
-                if not chunk:
-                    break
-                response_data += chunk
-            
-            client.close()
-            return response_data.decode('utf-8', errors='ignore')
-        except socket.timeout:
-            return "TIMEOUT"
-        except ConnectionRefusedError:
-            return "REFUSED"
-        except socket.gaierror:
-            return "DNS_ERROR"
-        except Exception as e:
-            return f"ERROR:{str(e)}"
+    def open_link(self):
+        self.close_link()
+        self.winner_listeners = []
+        self.link = ServerLink(self.server_ip, self.server_port).start()
     
-    def measure_latency(self):
-        """Measure ping latency to server"""
-        try:
-            start = time.time()
-            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client.settimeout(2)
-            client.connect((self.server_ip, int(self.server_port)))
-            client.close()
-            latency = (time.time() - start) * 1000
-            return latency
-        except:
-            return 0
-    
-    def update_stats(self):
-        """Update server stats in background"""
-        while self.is_connected:
-            response = self.send_request("GET_STATS", timeout=3)
-            if response and not response.startswith("ERROR") and response != "TIMEOUT":
-                try:
-                    self.stats = json.loads(response)
-                    if hasattr(self, 'stats_label'):
-                        stats_text = f"Online: {self.stats.get('online_players', 0)} | Winners: {self.stats.get('total_winners', 0)} | Pings: {self.stats.get('total_pings', 0)}"
-                        self.stats_label.config(text=stats_text)
-                    self.connection_status = "connected"
-                except:
-                    pass
-            else:
-                self.connection_status = "unstable"
-            time.sleep(3)
+    def close_link(self, message=None, wait=0):
+        """Close the current link, callbacks of its unfinished requests are dropped"""
+        if self.link:
+            self.link.close(message, wait)
+            self.link = None
+    
+    def poll_link(self):
+        """Run finished request callbacks on the Tk thread"""
+        if self.link:
+            self.link.dispatch()
+        self.root.after(20, self.poll_link)
     
-    def send_heartbeat(self):
-        """Send periodic heartbeat to stay connected"""
-        while self.is_connected:
+    def send_request(self, message, callback=None, timeout=5):
+        if self.link:
+            self.link.request(message, callback, timeout)
+    
+    def measure_latency(self, callback):
+        """Measure ping latency to server, callback(rtt_summary dict or None) runs on the Tk thread"""
+        if self.link:
+            self.link.probe(callback)
+    
+    def on_stats(self, response):
+        """Handle a periodic GET_STATS response"""
+        if response and not response.startswith("ERROR") and response != "TIMEOUT":
             try:
-                response = self.send_request(f"HEARTBEAT:{self.username}", timeout=2)
-                if response != "OK":
-                    self.connection_status = "unstable"
+                self.stats = json.loads(response)
+                if hasattr(self, 'stats_label') and self.stats_label.winfo_exists():
+                    stats_text = f"Online: {self.stats.get('online_players', 0)} | Winners: {self.stats.get('total_winners', 0)} | Pings: {self.stats.get('total_pings', 0)}"
+                    self.stats_label.config(text=stats_text)
+                self.connection_status = "connected"
             except:
-                self.connection_status = "unstable"
-            time.sleep(15)  # Send heartbeat every 15 seconds
+                pass
+        else:
+            self.connection_status = "unstable"
+    
+    def on_heartbeat(self, response):
+        """Handle a periodic heartbeat response"""
+        self.connection_status = "connected" if response == "OK" else "unstable"
+    
+    def on_push(self, payload):
+        """Handle a frame the server pushed: STATS:<json> or WINNERS:<leaderboard page json>"""
+        kind, _, body = payload.partition(":")
+        if kind == "STATS":
+            self.on_stats(body)
+        elif kind == "WINNERS":
+            try:
+                page = json.loads(body)
+            except json.JSONDecodeError:
+                return
+            for listener in list(self.winner_listeners):
+                listener(page)
     
     def show_connection_screen(self):
         for widget in self.root.winfo_children():
@@ -205,6 +696,9 @@ class P2WClient:
         return True
     
     def connect_to_server(self):
+        if self.connecting:
+            return
+        
         self.username = self.username_entry.get().strip()
         self.server_ip = self.ip_entry.get().strip()
         self.server_port = self.port_entry.get().strip()
@@ -212,20 +706,27 @@ class P2WClient:
         if not self.validate_input():
             return
         
+        # New server, new link (it tries the persistent protocol again)
+        self.open_link()
+        self.connecting = True
+        
         # Test connection and send CONNECT message
-        response = self.send_request(f"CONNECT:{self.username}")
+        self.send_request(f"CONNECT:{self.username}", self.on_connect_response)
+    
+    def on_connect_response(self, response):
+        self.connecting = False
         
         if response == "CONNECTED":
             self.is_connected = True
             self.save_config()
-            # Start stats update thread
-            self.stats_thread = threading.Thread(target=self.update_stats, daemon=True)
-            self.stats_thread.start()
-            # Start heartbeat thread
-            self.heartbeat_thread = threading.Thread(target=self.send_heartbeat, daemon=True)
-            self.heartbeat_thread.start()
+            # Heartbeats and stats are scheduled on the link, pushes are only asked for while a leaderboard is open
+            self.link.every(15, f"HEARTBEAT:{self.username}", self.on_heartbeat, timeout=2)
+            self.link.every(3, "GET_STATS", self.on_stats, timeout=3)
             self.show_game_screen()
-        elif response == "INVALID_USERNAME":
+            return
+        
+        self.close_link()
+        if response == "INVALID_USERNAME":
             messagebox.showerror("Error", "Invalid username! Use only letters, numbers, _ and -")
         elif response == "BLACKLISTED":
             messagebox.showerror("Error", "Your IP has been blacklisted from this server!")
@@ -239,10 +740,10 @@ class P2WClient:
             messagebox.showerror("Error", f"Connection failed: {response}")
     
     def disconnect(self):
-        if self.is_connected:
-            self.send_request(f"DISCONNECT:{self.username}")
-            self.is_connected = False
+        self.close_link(f"DISCONNECT:{self.username}" if self.is_connected else None)
+        self.is_connected = False
         self.has_pinged = False
+        self.ping_pending = False
         self.connection_status = "disconnected"
         self.show_connection_screen()
     
@@ -284,15 +785,15 @@ class P2WClient:
         )
         self.stats_label.pack(pady=5)
         
-        # Latency display
-        latency = self.measure_latency()
+        # Latency display, filled in when the first probe comes back
         self.latency_label = tk.Label(
             self.root,
-            text=f"Latency: {latency:.2f}ms",
+            text="Latency: measuring...",
             font=("Arial", 10, "bold"),
-            fg="green" if latency < 50 else "orange" if latency < 150 else "red"
+            fg="gray"
         )
         self.latency_label.pack(pady=5)
+        self.refresh_latency()
         
         # Refresh latency button
         refresh_btn = tk.Button(
@@ -381,24 +882,51 @@ class P2WClient:
     
     def refresh_latency(self):
         """Refresh latency measurement"""
-        latency = self.measure_latency()
+        self.measure_latency(self.show_latency)
+    
+    def show_latency(self, rtt):
+        if not self.is_connected or not self.latency_label.winfo_exists():
+            return
+        if rtt is None:
+            self.latency_label.config(text="Latency: no response", fg="red")
+            return
+        median = rtt['median']
         self.latency_label.config(
-            text=f"Latency: {latency:.2f}ms",
-            fg="green" if latency < 50 else "orange" if latency < 150 else "red"
+            text=f"Latency: {median:.2f}ms (min {rtt['min']:.2f}, jitter {rtt['jitter']:.2f})",
+            fg="green" if median < 50 else "orange" if median < 150 else "red"
         )
     
     def ping_server(self):
         if self.has_pinged:
             messagebox.showinfo("Info", "You can only ping once!")
             return
+        if self.ping_pending:
+            return
+        
+        # Measure latency, then send ping with username and latency
+        self.ping_pending = True
+        self.ping_btn.config(state="disabled")
+        self.measure_latency(self.send_ping)
+    
+    def send_ping(self, rtt):
+        self.show_latency(rtt)
+        # The server records the round trip it measured itself, this is only a fallback
+        latency = rtt['min'] if rtt else 0
+        message = f"P2W_PING:{self.username}|{latency}"
+        self.send_request(message, lambda response: self.on_ping_response(response, latency))
+    
+    def on_ping_response(self, response, latency, looked_up=False):
+        if response in ("TIMEOUT", "ERROR:connection lost") and not looked_up and self.is_connected:
+            # The ping may have been applied before its reply was lost, the leaderboard knows
+            self.send_request(f"GET_LEADERBOARD_USER:{self.username}",
+                              lambda lookup: self.on_ping_lookup(lookup, response, latency))
+            return
+        self.ping_pending = False
+        if not self.is_connected:
+            return
         
         try:
-            # Measure latency
-            latency = self.measure_latency()
-            
-            # Send ping with username and latency
-            message = f"P2W_PING:{self.username}|{latency}"
-            response = self.send_request(message)
+            self.ping_btn.config(state="normal")
             
             if response == "TIMEOUT":
                 messagebox.showerror("Error", "Request timed out! Server not responding.")
@@ -444,6 +972,39 @@ class P2WClient:
         except Exception as e:
             messagebox.showerror("Error", f"Connection error: {str(e)}")
     
+    def on_ping_lookup(self, lookup, response, latency):
+        try:
+            winner = json.loads(lookup).get('winner')
+        except (json.JSONDecodeError, AttributeError):
+            winner = None
+        if winner:
+            response = f"WIN:{winner['rank']}"
+        self.on_ping_response(response, latency, looked_up=True)
+    
+    def fetch_leaderboard_page(self, offset, callback, limit=100):
+        """Fetch one page of the leaderboard, callback gets a dict or an error string"""
+        def on_response(response):
+            if response == "INVALID_REQUEST" and offset == 0:
+                # Older server without paging, only the top 100 are available
+                self.send_request("GET_LEADERBOARD", lambda response: callback(self.parse_leaderboard_page(response)))
+            else:
+                callback(self.parse_leaderboard_page(response))
+        
+        self.send_request(f"GET_LEADERBOARD:{offset}:{limit}", on_response)
+    
+    def parse_leaderboard_page(self, response):
+        if response == "TIMEOUT":
+            return "Request timed out"
+        elif not response or response.startswith("ERROR") or response in ("REFUSED", "DNS_ERROR", "INVALID_REQUEST"):
+            return "Failed to load leaderboard"
+        
+        try:
+            page = json.loads(response)
+        except json.JSONDecodeError:
+            return "Failed to load leaderboard"
+        page.setdefault('next_offset', None)
+        return page
+    
     def show_leaderboard(self):
         # Create leaderboard window
         lb_window = tk.Toplevel(self.root)
@@ -456,78 +1017,81 @@ class P2WClient:
         title = tk.Label(title_frame, text="Leaderboard", font=("Arial", 18, "bold"))
         title.pack(side=tk.LEFT, padx=10)
         
+        summary = tk.Label(lb_window, text="Loading...", font=("Arial", 9), fg="gray")
+        summary.pack()
+        
+        # Only the rows on screen are fetched and shown, a million winners scroll like a hundred
+        view = LeaderboardView(lb_window, lambda offset, limit, callback: self.fetch_leaderboard_page(offset, callback, limit))
+        own = {}
+        
+        def update_summary():
+            if view.error:
+                summary.config(text=view.error, fg="red")
+            elif view.total == 0:
+                summary.config(text="No winners yet! Be the first!", fg="gray")
+            elif view.total is not None:
+                text = f"{view.total} winners"
+                if 'rank' in own:
+                    text += f" | Your rank: #{own['rank']}"
+                summary.config(text=text, fg="gray")
+        
+        def show_own_rank(response):
+            try:
+                me = json.loads(response).get('winner')
+            except (json.JSONDecodeError, AttributeError):
+                return
+            if me and summary.winfo_exists():
+                own['rank'] = me['rank']
+                my_rank_btn.config(state="normal")
+                update_summary()
+        
         refresh_lb_btn = tk.Button(
             title_frame,
             text="Refresh",
             font=("Arial", 10),
-            command=lambda: self.refresh_leaderboard(lb_window)
+            command=view.refresh
         )
         refresh_lb_btn.pack(side=tk.LEFT)
         
-        # Get leaderboard data
-        response = self.send_request("GET_LEADERBOARD")
+        my_rank_btn = tk.Button(
+            title_frame,
+            text="My Rank",
+            font=("Arial", 10),
+            state="disabled",
+            command=lambda: view.scroll_to(own['rank'] - 1 - view.visible // 2)
+        )
+        my_rank_btn.pack(side=tk.LEFT, padx=5)
         
-        if response == "TIMEOUT":
-            tk.Label(lb_window, text="Request timed out", fg="red").pack()
-            return
-        elif not response or response.startswith("ERROR"):
-            tk.Label(lb_window, text="Failed to load leaderboard", fg="red").pack()
-            return
+        view.on_change = update_summary
+        # Subscribed before the first page is read, so no winner falls between the two.
+        # Servers without pushes answer something else, Refresh still works there
+        if not self.winner_listeners and self.link:
+            self.link.subscribe(self.on_push)
+        view.request(0)
+        self.send_request(f"GET_LEADERBOARD_USER:{self.username}", show_own_rank)
         
-        try:
-            data = json.loads(response)
-            winners = data.get('winners', [])
-            
-            if not winners:
-                tk.Label(lb_window, text="No winners yet! Be the first!", font=("Arial", 12)).pack(pady=50)
-                return
-            
-            # Create treeview
-            frame = tk.Frame(lb_window)
-            frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
-            
-            scrollbar = ttk.Scrollbar(frame)
-            scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
-            
-            tree = ttk.Treeview(frame, columns=("Rank", "Username", "Time", "Latency"), show="headings", yscrollcommand=scrollbar.set)
-            scrollbar.config(command=tree.yview)
-            
-            tree.heading("Rank", text="Rank")
-            tree.heading("Username", text="Username")
-            tree.heading("Time", text="Time")
-            tree.heading("Latency", text="Latency")
-            
-            tree.column("Rank", width=60, anchor="center")
-            tree.column("Username", width=150, anchor="center")
-            tree.column("Time", width=180, anchor="center")
-            tree.column("Latency", width=100, anchor="center")
-            
-            for winner in winners:
-                tree.insert("", tk.END, values=(
-                    f"#{winner['rank']}",
-                    winner['username'],
-                    winner['timestamp'],
-                    winner.get('latency', 'N/A')
-                ))
-            
-            tree.pack(fill=tk.BOTH, expand=True)
-            
-        except Exception as e:
-            tk.Label(lb_window, text=f"Error: {str(e)}", fg="red").pack()
-    
-    def refresh_leaderboard(self, window):
-        """Refresh leaderboard data"""
-        window.destroy()
-        self.show_leaderboard()
+        # Pushed winners land in the cached pages they continue
+        def on_new_winners(pushed):
+            view.add_winners(pushed.get('offset', 0), pushed.get('winners', []), pushed.get('total', 0))
+        
+        def forget(event):
+            if event.widget is lb_window and on_new_winners in self.winner_listeners:
+                self.winner_listeners.remove(on_new_winners)
+                if not self.winner_listeners and self.link:
+                    self.link.unsubscribe()
+        
+        self.winner_listeners.append(on_new_winners)
+        lb_window.bind("<Destroy>", forget)
     
     def run(self):
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.poll_link()
         self.root.mainloop()
     
     def on_closing(self):
         """Clean shutdown"""
-        if self.is_connected:
-            self.send_request(f"DISCONNECT:{self.username}")
+        # Give the link a moment to send the DISCONNECT before the process exits
+        self.close_link(f"DISCONNECT:{self.username}" if self.is_connected else None, wait=2)
         self.root.destroy()
 
 if __name__ == "__main__":
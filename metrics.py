@@ -0,0 +1,214 @@
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Sentinel:
+    pass
+
+
+class Shard:
+    """Counters written by a single thread, so updates need no lock"""
+
+    def __init__(self):
+        self.requests = {}
+        self.errors = {}
+        self.buckets = {}
+        self.latency_sum = {}
+        self.lock_waits = {}
+        self.in_flight = 0
+        # Running total of this thread's lock waits and the share of the last request
+        self.waited = 0.0
+        self.last_wait = 0.0
+
+    def merge_into(self, totals):
+        # dict() and list() copies are atomic, the owning thread may still be writing
+        for key, value in dict(self.requests).items():
+            totals.requests[key] = totals.requests.get(key, 0) + value
+        for key, value in dict(self.errors).items():
+            totals.errors[key] = totals.errors.get(key, 0) + value
+        for key, value in dict(self.latency_sum).items():
+            totals.latency_sum[key] = totals.latency_sum.get(key, 0) + value
+        for key, counts in dict(self.buckets).items():
+            merged = totals.buckets.setdefault(key, [0] * (len(LATENCY_BUCKETS) + 1))
+            for i, n in enumerate(list(counts)):
+                merged[i] += n
+        for key, (waits, seconds) in dict(self.lock_waits).items():
+            merged = totals.lock_waits.setdefault(key, [0, 0.0])
+            merged[0] += waits
+            merged[1] += seconds
+        totals.in_flight += self.in_flight
+
+
+class Metrics:
+    """Per-command request metrics sharded by thread.
+
+    Every thread updates its own Shard and a scrape sums them. Shards of
+    threads that have exited are folded into retired so per-connection
+    threads don't pile up.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.shards = {}
+        self.retired = Shard()
+
+    def shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = Shard()
+            # The sentinel dies with the thread's locals, that's when the shard is retired
+            sentinel = self.local.sentinel = Sentinel()
+            with self.lock:
+                self.shards[id(shard)] = shard
+            weakref.finalize(sentinel, self.retire, shard)
+            return shard
+
+    def retire(self, shard):
+        with self.lock:
+            self.shards.pop(id(shard), None)
+            shard.merge_into(self.retired)
+
+    def start_request(self):
+        """Returns a token for finish_request"""
+        shard = self.shard()
+        shard.in_flight += 1
+        return shard.waited
+
+    def finish_request(self, command, seconds, error=None, token=0.0):
+        shard = self.shard()
+        shard.in_flight -= 1
+        shard.last_wait = shard.waited - token
+        shard.requests[command] = shard.requests.get(command, 0) + 1
+        shard.latency_sum[command] = shard.latency_sum.get(command, 0) + seconds
+        buckets = shard.buckets.get(command)
+        if buckets is None:
+            buckets = shard.buckets[command] = [0] * (len(LATENCY_BUCKETS) + 1)
+        buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        if error:
+            key = (command, error)
+            shard.errors[key] = shard.errors.get(key, 0) + 1
+
+    def lock_wait(self, name, seconds):
+        shard = self.shard()
+        waits = shard.lock_waits
+        entry = waits.get(name)
+        if entry is None:
+            entry = waits[name] = [0, 0.0]
+        entry[0] += 1
+        entry[1] += seconds
+        shard.waited += seconds
+
+    def last_lock_wait(self):
+        """Seconds the calling thread's most recent request spent waiting for locks"""
+        return self.shard().last_wait
+
+    def collect(self):
+        totals = Shard()
+        with self.lock:
+            self.retired.merge_into(totals)
+            for shard in list(self.shards.values()):
+                shard.merge_into(totals)
+        return totals
+
+    def render(self, gauges=()):
+        """Text exposition format, gauges are extra (name, help, type, value) samples"""
+        totals = self.collect()
+        lines = []
+
+        def header(name, help_text, kind):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        header("p2w_requests_total", "Requests handled, by command", "counter")
+        for command, n in sorted(totals.requests.items()):
+            lines.append(f'p2w_requests_total{{command="{command}"}} {n}')
+
+        header("p2w_request_errors_total", "Requests answered with an error, by command and reason", "counter")
+        for (command, reason), n in sorted(totals.errors.items()):
+            lines.append(f'p2w_request_errors_total{{command="{command}",reason="{reason}"}} {n}')
+
+        header("p2w_request_duration_seconds", "Time spent handling a request", "histogram")
+        for command, counts in sorted(totals.buckets.items()):
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += n
+                lines.append(f'p2w_request_duration_seconds_bucket{{command="{command}",le="{bound}"}} {cumulative}')
+            lines.append(f'p2w_request_duration_seconds_sum{{command="{command}"}} {totals.latency_sum[command]:.6f}')
+            lines.append(f'p2w_request_duration_seconds_count{{command="{command}"}} {cumulative}')
+
+        header("p2w_requests_in_flight", "Requests currently being handled", "gauge")
+        lines.append(f"p2w_requests_in_flight {totals.in_flight}")
+
+        header("p2w_lock_waits_total", "Contended lock acquisitions", "counter")
+        for name, (waits, _) in sorted(totals.lock_waits.items()):
+            lines.append(f'p2w_lock_waits_total{{lock="{name}"}} {waits}')
+        header("p2w_lock_wait_seconds_total", "Time spent waiting for contended locks", "counter")
+        for name, (_, seconds) in sorted(totals.lock_waits.items()):
+            lines.append(f'p2w_lock_wait_seconds_total{{lock="{name}"}} {seconds:.6f}')
+
+        for name, help_text, kind, value in gauges:
+            header(name, help_text, kind)
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class TimedLock:
+    """Lock wrapper that reports how long contended acquisitions waited"""
+
+    def __init__(self, lock, name, metrics):
+        self.lock = lock
+        self.name = name
+        self.metrics = metrics
+
+    def acquire(self, blocking=True, timeout=-1):
+        # The uncontended path costs one extra non-blocking attempt and no clock reads
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.metrics.lock_wait(self.name, time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+def serve_metrics(host, port, render):
+    """Serve render() at /metrics from a daemon thread, returns the HTTP server"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = render().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
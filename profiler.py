@@ -0,0 +1,86 @@
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+
+class SlowRequestLog:
+    """Ring buffer of per-phase timings for requests slower than a threshold"""
+
+    def __init__(self, threshold_ms=50, size=256, enabled=False):
+        self.threshold = threshold_ms / 1000
+        self.entries = deque(maxlen=size)
+        self.enabled = enabled
+
+    def add(self, data, ip, total, phases):
+        self.entries.append({
+            'ts': round(time.time(), 3),
+            'request': data[:64],
+            'ip': ip,
+            'total_ms': round(total * 1000, 3),
+            'phases_ms': {name: round(seconds * 1000, 3) for name, seconds in phases.items()}
+        })
+
+    def snapshot(self):
+        return list(self.entries)
+
+
+class SamplingProfiler:
+    """Samples every thread's stack at a fixed interval and counts them as collapsed stacks.
+
+    The output is one "frame;frame;frame count" line per distinct stack,
+    root first, which flamegraph.pl and speedscope read directly.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = {}
+        self.samples = 0
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.running:
+            return False
+        self.counts = {}
+        self.samples = 0
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return True
+
+    def run(self):
+        own = threading.get_ident()
+        labels = {}
+        while not self.stop_event.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+                    stack.append(label)
+                    frame = frame.f_back
+                key = ";".join(reversed(stack))
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self, path):
+        """Stop sampling and write the collapsed stacks to path, returns the number of samples"""
+        if not self.running:
+            return 0
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        with open(path, 'w') as f:
+            for stack, n in sorted(self.counts.items(), key=lambda item: -item[1]):
+                f.write(f"{stack} {n}\n")
+        return self.samples
@@ -0,0 +1,131 @@
+import socket
+
+# A client opts into the persistent protocol by sending this line first.
+# Anything else is treated as a classic one-shot request, so old clients keep working.
+STREAM_HELLO = "P2W_STREAM"
+STREAM_HELLO_BYTES = (STREAM_HELLO + "\n").encode('utf-8')
+STREAM_OK = "STREAM_OK"
+# Sent instead of STREAM_OK when the server has no room for another session, plain requests still work
+STREAM_BUSY = "STREAM_BUSY"
+# Frames the server sends on its own to subscribed connections, never a reply to a command
+PUSH_PREFIX = "PUSH:"
+PUSH_PREFIX_BYTES = PUSH_PREFIX.encode('utf-8')
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class StreamBusy(ProtocolError):
+    """The server supports persistent connections but has none to spare right now"""
+
+
+def encode_frame(message):
+    """Frame a message as <length>:<payload>\\n"""
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    return str(len(message)).encode('ascii') + b":" + message + b"\n"
+
+
+class FrameDecoder:
+    """Incrementally split a byte stream into frames"""
+
+    def __init__(self, max_frame_bytes=1 << 20):
+        self.buffer = bytearray()
+        self.max_frame_bytes = max_frame_bytes
+
+    def feed(self, data):
+        """Add received bytes and return every complete frame as a string"""
+        self.buffer += data
+        frames = []
+        while True:
+            colon = self.buffer.find(b":", 0, 12)
+            if colon == -1:
+                if len(self.buffer) >= 12:
+                    raise ProtocolError("missing frame length")
+                break
+            length_field = bytes(self.buffer[:colon])
+            if not length_field.isdigit():
+                raise ProtocolError("bad frame length")
+            length = int(length_field)
+            if length > self.max_frame_bytes:
+                raise ProtocolError("frame too large")
+            end = colon + 1 + length
+            if len(self.buffer) < end + 1:
+                break
+            if self.buffer[end] != 0x0A:
+                raise ProtocolError("missing frame delimiter")
+            frames.append(self.buffer[colon + 1:end].decode('utf-8', errors='ignore'))
+            del self.buffer[:end + 1]
+        return frames
+
+
+class StreamConnection:
+    """Client side of a long-lived connection with pipelined commands"""
+
+    def __init__(self, host, port, timeout=5, on_push=None):
+        self.host = host
+        self.port = int(port)
+        self.timeout = timeout
+        self.sock = None
+        self.decoder = FrameDecoder()
+        self.frames = []
+        # Called with the payload after PUSH: for frames that aren't replies
+        self.on_push = on_push
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(STREAM_HELLO_BYTES)
+        try:
+            reply = self.recv_frame()
+        except (ProtocolError, ConnectionError):
+            reply = None
+        if reply == STREAM_BUSY:
+            self.close()
+            raise StreamBusy("server has no room for another persistent connection")
+        if reply != STREAM_OK:
+            self.close()
+            raise ProtocolError("server does not support persistent connections")
+
+    def send(self, messages):
+        """Write several commands in one go without waiting for replies"""
+        self.sock.sendall(b"".join(encode_frame(m) for m in messages))
+
+    def recv_frame(self):
+        while True:
+            while not self.frames:
+                self.receive()
+            frame = self.frames.pop(0)
+            if self.on_push and frame.startswith(PUSH_PREFIX):
+                self.on_push(frame[len(PUSH_PREFIX):])
+                continue
+            return frame
+
+    def receive(self):
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed by server")
+        self.frames.extend(self.decoder.feed(chunk))
+
+    def read_pushes(self):
+        """Deliver pushes that arrived while no reply was pending, call when the socket is readable"""
+        self.receive()
+        while self.frames and self.frames[0].startswith(PUSH_PREFIX):
+            self.on_push(self.frames.pop(0)[len(PUSH_PREFIX):])
+
+    def request(self, message):
+        return self.pipeline([message])[0]
+
+    def pipeline(self, messages):
+        """Send all commands, then collect their responses in order"""
+        self.send(messages)
+        return [self.recv_frame() for _ in messages]
+
+    def close(self):
+        if self.sock:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
@@ -1,56 +1,1050 @@
 import socket
+import select
+import sys
+import asyncio
+import multiprocessing
 import json
 import threading
 import time
 import re
+import ipaddress
+import argparse
+import struct
+import mmap
+import zlib
+import signal
 import shutil
+import os
 from os import system, path
 from datetime import datetime
-from collections import deque
+from collections import deque, OrderedDict
+from itertools import islice, count
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from metrics import Metrics, TimedLock, serve_metrics
+from profiler import SlowRequestLog, SamplingProfiler
+from protocol import STREAM_HELLO_BYTES, STREAM_OK, STREAM_BUSY, PUSH_PREFIX_BYTES, FrameDecoder, ProtocolError, encode_frame
+
+class EventLog:
+    """Queued logger, callers only append to a deque and a background thread writes batches.
+    
+    Lines are either the classic "[HH:MM:SS] message" text or JSON objects
+    (one per line) for headless runs. Events listed in sample_every are only
+    recorded once every N occurrences. When the writer falls behind by
+    max_queue entries the oldest ones are dropped instead of blocking callers.
+    """
+    
+    def __init__(self, stream=None, json_lines=False, sample_every=None, max_queue=100000, flush_interval=0.25):
+        self.stream = stream or sys.stdout
+        self.json_lines = json_lines
+        self.sample_every = dict(sample_every or {})
+        # next() on a count is atomic, so sampling needs no lock
+        self.sample_counters = {event: count() for event in self.sample_every}
+        self.queue = deque(maxlen=max_queue)
+        self.flush_interval = flush_interval
+    
+    def emit(self, event, message, **fields):
+        every = self.sample_every.get(event)
+        if every and next(self.sample_counters[event]) % every:
+            return
+        self.queue.append((time.time(), event, message, fields))
+    
+    def run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+    
+    def flush(self):
+        lines = []
+        while self.queue:
+            timestamp, event, message, fields = self.queue.popleft()
+            if self.json_lines:
+                record = {'ts': round(timestamp, 3), 'event': event}
+                record.update(fields)
+                if event in self.sample_every:
+                    record['sampled'] = self.sample_every[event]
+                lines.append(json.dumps(record) + "\n")
+            else:
+                lines.append(f"[{datetime.fromtimestamp(timestamp).strftime('%H:%M:%S')}] {message}\n")
+        if lines:
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                pass
+
+
+def partial_hello(raw):
+    """True while raw could still become the stream hello, TCP may deliver it in pieces"""
+    return bool(raw) and len(raw) < len(STREAM_HELLO_BYTES) and STREAM_HELLO_BYTES.startswith(raw)
+
+
+def tcp_rtt(sock):
+    """Kernel's smoothed RTT estimate of a TCP connection in ms, None where TCP_INFO isn't available"""
+    if sock is None or not hasattr(socket, "TCP_INFO"):
+        return None
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 104)
+    except OSError:
+        return None
+    if len(info) < 72:
+        return None
+    # struct tcp_info: 8 bytes of u8 fields, then u32s, tcpi_rtt (microseconds) is the 16th
+    rtt = struct.unpack_from('=I', info, 68)[0]
+    return rtt / 1000 if rtt else None
+
+
+def writable(sock):
+    """True when sock can take at least some bytes right now"""
+    if hasattr(select, "poll"):
+        # poll() has no FD_SETSIZE limit, select() does
+        poller = select.poll()
+        poller.register(sock, select.POLLOUT)
+        return bool(poller.poll(0))
+    return bool(select.select([], [sock], [], 0)[1])
+
+
+class SocketWriter:
+    """Ordered writes to a threaded-mode socket from several threads.
+    
+    write() never blocks: it queues the data and sends what the socket
+    takes right away, the rest goes out with a later write. The publisher
+    thread pushes through it, so one subscriber that stopped reading
+    can't hold up the fan-out, it just builds a backlog. write_all() is
+    for the connection's own thread and waits until the queue is sent.
+    The socket needs a timeout, that keeps its descriptor non-blocking.
+    """
+    
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.lock = threading.Lock()
+        # Held by whichever thread is sending, only that one removes from buffer
+        self.send_lock = threading.Lock()
+    
+    def backlog(self):
+        return len(self.buffer)
+    
+    def write(self, data):
+        with self.lock:
+            self.buffer += data
+        self.pump()
+    
+    def write_all(self, data):
+        with self.lock:
+            self.buffer += data
+        with self.send_lock:
+            self.flush(wait=True)
+        # Whatever was queued while this thread held send_lock
+        self.pump()
+    
+    def pump(self):
+        """Send without waiting, unless another thread is already sending"""
+        while self.buffer and self.send_lock.acquire(blocking=False):
+            try:
+                if not self.flush(wait=False):
+                    return
+            finally:
+                self.send_lock.release()
+    
+    def flush(self, wait):
+        """Send the queue, False when the socket is full and wait is off"""
+        while True:
+            with self.lock:
+                if not self.buffer:
+                    return True
+                chunk = bytes(self.buffer[:65536])
+            if not wait and not writable(self.sock):
+                return False
+            sent = self.sock.send(chunk)
+            with self.lock:
+                del self.buffer[:sent]
+
+
+class StreamSession:
+    """State of one persistent connection: its push subscription and measured round trips.
+    
+    send must be callable from any thread. RTT samples are taken by the
+    server itself, from sending an RTT_ACK to receiving the next
+    RTT_PROBE that echoes its token. The token is random, so a client can
+    delay the echo but can't answer before the ACK arrived.
+    """
+    
+    def __init__(self, send, backlog=None, sock=None):
+        self.send = send
+        # Bytes written but not yet taken by the socket
+        self.backlog = backlog
+        self.sock = sock
+        self.cursor = None
+        self.stats = None
+        self.rtt_token = None
+        self.rtt_sent = 0
+        self.rtt_samples = deque(maxlen=16)
+    
+    def rtt_probe(self, echo):
+        """RTT_PROBE[:<token of the last RTT_ACK>], returns RTT_ACK:<new token>:<server perf_counter_ns>"""
+        now = time.perf_counter_ns()
+        if echo and echo == self.rtt_token:
+            self.rtt_samples.append(now - self.rtt_sent)
+        self.rtt_token = os.urandom(8).hex()
+        self.rtt_sent = now
+        return f"RTT_ACK:{self.rtt_token}:{now}".encode('ascii')
+    
+    def measured_rtt(self):
+        """Best round trip in ms: the lowest probe sample, or the kernel's estimate without probes"""
+        if self.rtt_samples:
+            return min(self.rtt_samples) / 1e6
+        return tcp_rtt(self.sock)
+
+
+class Publisher:
+    """Pushes stats and newly appended winners to subscribed connections.
+    
+    A single thread reads the server through respond() once per interval,
+    one GET_STATS plus the leaderboard pages between each distinct cursor
+    and the newest winner, and fans the same pre-encoded frames out to
+    every subscriber. Read load follows the rate of change instead of
+    clients times poll rate. Stats are only pushed when something besides
+    uptime changed. One interval sends a subscriber at most about
+    max_backlog bytes, a subscriber whose backlog exceeds max_backlog is
+    skipped until it drains, its cursor stays put so it still gets every
+    winner.
+    """
+    
+    def __init__(self, respond, interval=1.0, page_size=100, max_backlog=1 << 20):
+        self.respond = respond
+        self.interval = interval
+        self.page_size = page_size
+        self.max_backlog = max_backlog
+        self.subscriptions = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.frames_sent = 0
+    
+    def __len__(self):
+        return len(self.subscriptions)
+    
+    def subscribe(self, subscription, since=None):
+        """Start pushing to subscription, winners are sent from rank since + 1 (default: from now on)"""
+        subscription.cursor = since
+        subscription.stats = None
+        with self.lock:
+            self.subscriptions.add(subscription)
+            # Started on first use, so processes nobody subscribes to don't run it
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+    
+    def unsubscribe(self, subscription):
+        with self.lock:
+            self.subscriptions.discard(subscription)
+    
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                subscriptions = list(self.subscriptions)
+            if subscriptions:
+                self.publish(subscriptions)
+    
+    def publish(self, subscriptions):
+        stats = self.respond("GET_STATS", "push")
+        try:
+            parsed = json.loads(stats)
+        except ValueError:
+            return
+        total = parsed['total_winners']
+        parsed.pop('uptime', None)
+        stats_key = tuple(sorted(parsed.items()))
+        stats_frame = encode_frame(PUSH_PREFIX_BYTES + b"STATS:" + stats)
+        pages = {}
+        
+        for subscription in subscriptions:
+            if subscription.backlog and subscription.backlog():
+                try:
+                    # An empty write sends whatever of the backlog the socket takes by now
+                    subscription.send(b"")
+                except OSError:
+                    self.unsubscribe(subscription)
+                    continue
+                if subscription.backlog() > self.max_backlog:
+                    continue
+            if subscription.cursor is None:
+                subscription.cursor = total
+            frames = []
+            if subscription.stats != stats_key:
+                frames.append(stats_frame)
+            cursor = subscription.cursor
+            size = len(frames[0]) if frames else 0
+            # Page after page up to the newest winner, so a subscriber that fell behind catches up
+            while cursor < total and size <= self.max_backlog:
+                if cursor not in pages:
+                    pages[cursor] = self.winners_page(cursor)
+                frame, next_cursor = pages[cursor]
+                if not frame:
+                    break
+                frames.append(frame)
+                size += len(frame)
+                cursor = next_cursor
+            if not frames:
+                continue
+            try:
+                subscription.send(b"".join(frames))
+            except OSError:
+                self.unsubscribe(subscription)
+                continue
+            subscription.stats = stats_key
+            subscription.cursor = cursor
+            self.frames_sent += len(frames)
+    
+    def winners_page(self, cursor):
+        """PUSH:WINNERS frame with the winners after cursor (None if there are none) and the cursor after them"""
+        page = self.respond(f"GET_LEADERBOARD:{cursor}:{self.page_size}", "push")
+        try:
+            count = len(json.loads(page)['winners'])
+        except (ValueError, KeyError, TypeError):
+            count = 0
+        if not count:
+            return None, cursor
+        return encode_frame(PUSH_PREFIX_BYTES + b"WINNERS:" + page), cursor + count
+
+
+class TimerWheel:
+    """Hashed timing wheel: schedule, cancel and expire cost O(1) per entry"""
+    
+    def __init__(self, resolution=1.0):
+        self.resolution = resolution
+        self.slots = {}       # tick -> keys due in that tick
+        self.deadlines = {}   # key -> tick
+        self.current_tick = int(time.time() / resolution)
+    
+    def __len__(self):
+        return len(self.deadlines)
+    
+    def schedule(self, key, deadline):
+        """(Re)arm key to expire once deadline has passed"""
+        tick = max(int(deadline / self.resolution) + 1, self.current_tick)
+        old_tick = self.deadlines.get(key)
+        if old_tick == tick:
+            return
+        if old_tick is not None:
+            self.remove_from_slot(key, old_tick)
+        self.deadlines[key] = tick
+        self.slots.setdefault(tick, set()).add(key)
+    
+    def cancel(self, key):
+        tick = self.deadlines.pop(key, None)
+        if tick is not None:
+            self.remove_from_slot(key, tick)
+    
+    def remove_from_slot(self, key, tick):
+        slot = self.slots[tick]
+        slot.discard(key)
+        if not slot:
+            del self.slots[tick]
+    
+    def expire(self, now):
+        """Remove and return every key whose deadline is before now"""
+        expired = []
+        now_tick = int(now / self.resolution)
+        while self.current_tick <= now_tick:
+            keys = self.slots.pop(self.current_tick, None)
+            if keys:
+                for key in keys:
+                    del self.deadlines[key]
+                expired.extend(keys)
+            self.current_tick += 1
+        return expired
+
+
+class CountMinSketch:
+    """Fixed-size approximate counter, never undercounts"""
+    
+    def __init__(self, width=4096, depth=4):
+        self.width = width
+        self.rows = [array('I', bytes(4 * width)) for _ in range(depth)]
+    
+    def add(self, key):
+        for salt, row in enumerate(self.rows):
+            row[hash((salt, key)) % self.width] += 1
+    
+    def estimate(self, key):
+        return min(row[hash((salt, key)) % self.width] for salt, row in enumerate(self.rows))
+    
+    def clear(self):
+        for row in self.rows:
+            row[:] = array('I', bytes(4 * self.width))
+
+
+def subnet_of(ip):
+    """Aggregation key for an address: its /24 for IPv4, its /64 for IPv6"""
+    if ip.startswith("::ffff:") and "." in ip:
+        ip = ip[7:]
+    if ":" not in ip:
+        return ip.rsplit(".", 1)[0] + ".0/24"
+    try:
+        return ipaddress.IPv6Address(ip).exploded[:19] + "::/64"
+    except ValueError:
+        return ip
+
+
+class TokenBucketLimiter:
+    """Token buckets per ip and per subnet with an atomic check-and-consume.
+    
+    Buckets are dropped once they have refilled, and past max_buckets new
+    keys are tracked approximately in a count-min sketch so memory stays bounded.
+    """
+    
+    def __init__(self, tiers, max_buckets=100000):
+        # tiers: list of (key function, burst capacity, seconds per token)
+        self.tiers = tiers
+        self.max_buckets = max_buckets
+        self.buckets = {}   # key -> [tokens, last refill time]
+        self.expiry = TimerWheel()
+        self.sketch = CountMinSketch()
+        self.sketch_window = max(capacity * interval for _, capacity, interval in tiers)
+        self.sketch_reset = time.time() + self.sketch_window
+        self.lock = threading.Lock()
+    
+    def __len__(self):
+        return len(self.buckets)
+    
+    def consume(self, ip):
+        """Take one token from every tier, returns (allowed, seconds to wait)"""
+        now = time.time()
+        with self.lock:
+            if now >= self.sketch_reset:
+                self.sketch.clear()
+                self.sketch_reset = now + self.sketch_window
+            
+            checks = []
+            wait = 0
+            for key_func, capacity, interval in self.tiers:
+                key = (capacity, interval, key_func(ip))
+                bucket = self.buckets.get(key)
+                if bucket is None and len(self.buckets) >= self.max_buckets:
+                    # Long tail: approximate count for this window instead of a bucket
+                    if self.sketch.estimate(key) >= capacity:
+                        wait = max(wait, self.sketch_reset - now)
+                    checks.append((key, None, capacity, interval))
+                    continue
+                
+                tokens = capacity if bucket is None else min(capacity, bucket[0] + (now - bucket[1]) / interval)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) * interval)
+                checks.append((key, tokens, capacity, interval))
+            
+            if wait > 0:
+                return False, wait
+            
+            for key, tokens, capacity, interval in checks:
+                if tokens is None:
+                    self.sketch.add(key)
+                    continue
+                self.buckets[key] = [tokens - 1, now]
+                # A full bucket is the same as no bucket, forget it once refilled
+                self.expiry.schedule(key, now + (capacity - tokens + 1) * interval)
+            return True, 0
+    
+    def expire(self, now):
+        with self.lock:
+            for key in self.expiry.expire(now):
+                del self.buckets[key]
+
+
+class RowIndex:
+    """Open-addressing hash index from a key to a row number, rows are never removed.
+    
+    The table only holds row numbers, key_of(row) reads the key back from the
+    store's columns. Growing moves a few old slots per insert instead of
+    rehashing everything at once, so an append never stalls on a resize.
+    """
+    
+    EMPTY = 0xFFFFFFFF
+    MIGRATE_PER_PUT = 8
+    
+    def __init__(self, key_of, hash_of, capacity=1024, table=None, size=0):
+        self.key_of = key_of
+        self.hash_of = hash_of
+        if table is None:
+            # Power of two with room for capacity keys at half load
+            capacity = 1 << max(10, (2 * capacity - 1).bit_length())
+            table = array('I', [self.EMPTY]) * capacity
+        self.table = table
+        self.old_table = None
+        self.migrated = 0
+        self.size = size
+    
+    def find_slot(self, table, key, h):
+        """Slot holding key, or the empty slot where it would go"""
+        mask = len(table) - 1
+        i = h & mask
+        while True:
+            row = table[i]
+            if row == self.EMPTY or self.key_of(row) == key:
+                return i
+            i = (i + 1) & mask
+    
+    def get(self, key):
+        h = self.hash_of(key)
+        row = self.table[self.find_slot(self.table, key, h)]
+        if row == self.EMPTY and self.old_table is not None:
+            row = self.old_table[self.find_slot(self.old_table, key, h)]
+        return None if row == self.EMPTY else row
+    
+    def put(self, key, row):
+        """Point key at row, rows must be added in increasing order"""
+        if self.old_table is not None:
+            self.migrate(self.MIGRATE_PER_PUT)
+        elif self.size * 2 >= len(self.table):
+            self.old_table = self.table
+            self.table = array('I', [self.EMPTY]) * (2 * len(self.old_table))
+            self.migrated = 0
+        
+        h = self.hash_of(key)
+        slot = self.find_slot(self.table, key, h)
+        if self.table[slot] == self.EMPTY:
+            if self.old_table is None or self.old_table[self.find_slot(self.old_table, key, h)] == self.EMPTY:
+                self.size += 1
+        self.table[slot] = row
+    
+    def migrate(self, count):
+        old_table = self.old_table
+        end = min(self.migrated + count, len(old_table))
+        for i in range(self.migrated, end):
+            row = old_table[i]
+            if row != self.EMPTY:
+                key = self.key_of(row)
+                slot = self.find_slot(self.table, key, self.hash_of(key))
+                # A key already in the new table was re-pointed at a newer row
+                if self.table[slot] == self.EMPTY:
+                    self.table[slot] = row
+        self.migrated = end
+        if end == len(old_table):
+            self.old_table = None
+    
+    def finish_migration(self):
+        if self.old_table is not None:
+            self.migrate(len(self.old_table))
+
+
+def hash_int(value):
+    """Spread integer keys (packed IPs are mostly sequential) across the table"""
+    return ((value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 16
+
+
+def hash_ip6(value):
+    """128-bit keys, both halves feed the hash"""
+    return hash_int(value ^ (value >> 64))
+
+
+def hash_name(name):
+    """Stable across processes (unlike hash()), index tables are saved in snapshots"""
+    return zlib.crc32(name.encode('utf-8'))
+
+
+class Column:
+    """Typed column whose first rows may be a view into a mapped snapshot file"""
+    
+    def __init__(self, typecode, base=None):
+        self.base = base if base is not None else array(typecode)
+        self.base_len = len(self.base)
+        self.tail = array(typecode)
+    
+    def __len__(self):
+        return self.base_len + len(self.tail)
+    
+    def __getitem__(self, i):
+        return self.base[i] if i < self.base_len else self.tail[i - self.base_len]
+    
+    def append(self, value):
+        self.tail.append(value)
+    
+    def chunks(self, count):
+        """Raw bytes of the first count rows, without holding on to array buffers"""
+        yield self.base[:min(count, self.base_len)]
+        if count > self.base_len:
+            yield self.tail[:count - self.base_len]
+
+
+class WinnerStore:
+    """Winners kept in parallel columns instead of one dict each, rank is row + 1.
+    
+    Usernames live in one byte blob, timestamps are epoch seconds, latency is a
+    float and IP addresses are stored as integers. Legacy dicts only exist at
+    the edges (JSON files, journal records and responses). A store loaded from a
+    binary snapshot serves its first rows straight from the mapped file.
+    """
+    
+    TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+    NO_ROW = RowIndex.EMPTY
+    
+    # Binary snapshot: header, then one (offset, length) pair per section
+    MAGIC = b'P2WB'
+    VERSION = 2
+    HEADER = struct.Struct('<4sHHQQQQ')  # magic, version, reserved, count, total_pings, username keys, ip keys
+    SECTIONS = ('names', 'name_ends', 'timestamps', 'latencies', 'ips', 'prev_same_ip',
+                'ip6_hi', 'ip6_lo', 'username_index', 'ip_index')
+    # Version 1 kept every address that wasn't IPv4 as a line of text
+    SECTIONS_V1 = ('names', 'name_ends', 'timestamps', 'latencies', 'ips', 'prev_same_ip',
+                   'other_ips', 'username_index', 'ip_index')
+    SECTION = struct.Struct('<QQ')
+    TYPECODES = {'name_ends': 'Q', 'timestamps': 'q', 'latencies': 'f', 'ips': 'Q', 'prev_same_ip': 'I',
+                 'ip6_hi': 'Q', 'ip6_lo': 'Q', 'username_index': 'I', 'ip_index': 'I'}
+    IP6_BASE = 1 << 32
+    UNKNOWN_IP = (1 << 64) - 1  # an address that is neither IPv4 nor IPv6, read back as ""
+    
+    def __init__(self):
+        self.mapping = None
+        self.name_base = b''
+        self.name_tail = bytearray()
+        self.name_ends = Column('Q')
+        self.timestamps = Column('q')
+        self.latencies = Column('f')
+        self.ips = Column('Q')           # IPv4 as int, IPv6 is IP6_BASE + its number in the ip6 columns
+        self.prev_same_ip = Column('I')  # previous row with the same ip, chains ip lookups
+        # Distinct IPv6 addresses as two 64-bit halves, numbered in order of first appearance
+        self.ip6_hi = Column('Q')
+        self.ip6_lo = Column('Q')
+        self.ip6_ids = RowIndex(self.ip6_of, hash_ip6)
+        self.by_username = RowIndex(self.username_of, hash_name)
+        self.by_ip = RowIndex(self.ips.__getitem__, hash_int)
+    
+    def __len__(self):
+        return len(self.name_ends)
+    
+    def __contains__(self, username):
+        return self.by_username.get(username) is not None
+    
+    def username_of(self, row):
+        start = self.name_ends[row - 1] if row else 0
+        end = self.name_ends[row]
+        base_len = len(self.name_base)
+        if end <= base_len:
+            return bytes(self.name_base[start:end]).decode('utf-8')
+        return self.name_tail[start - base_len:end - base_len].decode('utf-8')
+    
+    def ip6_of(self, ip_id):
+        return (self.ip6_hi[ip_id] << 64) | self.ip6_lo[ip_id]
+    
+    def pack_ip(self, ip, add=True):
+        """Column value for ip, None for an IPv6 address not seen before unless add"""
+        try:
+            if ip.count('.') == 3:
+                return int.from_bytes(socket.inet_aton(ip), 'big')
+            # The zone of a link-local address is local to the server, it isn't kept
+            value = int.from_bytes(socket.inet_pton(socket.AF_INET6, ip.split('%', 1)[0]), 'big')
+        except (OSError, ValueError):
+            return self.UNKNOWN_IP
+        ip_id = self.ip6_ids.get(value)
+        if ip_id is None:
+            if not add:
+                return None
+            ip_id = len(self.ip6_lo)
+            self.ip6_hi.append(value >> 64)
+            # Appended last so a snapshot never sees half an address
+            self.ip6_lo.append(value & 0xFFFFFFFFFFFFFFFF)
+            self.ip6_ids.put(value, ip_id)
+        return self.IP6_BASE + ip_id
+    
+    def unpack_ip(self, packed):
+        if packed < self.IP6_BASE:
+            return socket.inet_ntoa(packed.to_bytes(4, 'big'))
+        if packed == self.UNKNOWN_IP:
+            return ""
+        return socket.inet_ntop(socket.AF_INET6, self.ip6_of(packed - self.IP6_BASE).to_bytes(16, 'big'))
+    
+    def append(self, username, timestamp, ip, latency):
+        """Add a winner and return its rank"""
+        row = len(self)
+        packed = self.pack_ip(ip)
+        self.name_tail += username.encode('utf-8')
+        self.timestamps.append(int(timestamp))
+        self.latencies.append(latency)
+        self.ips.append(packed)
+        previous = self.by_ip.get(packed)
+        self.prev_same_ip.append(self.NO_ROW if previous is None else previous)
+        # Appended last so len() never counts a half-written row
+        self.name_ends.append(len(self.name_base) + len(self.name_tail))
+        
+        if self.by_username.get(username) is None:
+            self.by_username.put(username, row)
+        self.by_ip.put(packed, row)
+        return row + 1
+    
+    @staticmethod
+    def parse_legacy(winner):
+        """(username, timestamp, ip, latency) from the JSON {'username', 'timestamp', 'ip', 'rank', 'latency'} shape"""
+        try:
+            timestamp = datetime.fromisoformat(winner['timestamp']).timestamp()
+        except (KeyError, TypeError, ValueError):
+            timestamp = 0
+        try:
+            latency = float(str(winner.get('latency', 0)).rstrip('ms'))
+        except ValueError:
+            latency = 0
+        return winner['username'], timestamp, winner.get('ip', ''), latency
+    
+    def append_legacy(self, winner):
+        return self.append(*self.parse_legacy(winner))
+    
+    def extend_legacy(self, winners):
+        """Bulk load legacy dicts into an empty store, indexes are built once at the end"""
+        for winner in winners:
+            username, timestamp, ip, latency = self.parse_legacy(winner)
+            self.name_tail += username.encode('utf-8')
+            self.timestamps.append(int(timestamp))
+            self.latencies.append(latency)
+            self.ips.append(self.pack_ip(ip))
+            self.name_ends.append(len(self.name_tail))
+        self.rebuild_indexes()
+    
+    def rebuild_indexes(self):
+        total = len(self)
+        self.by_username = RowIndex(self.username_of, hash_name, capacity=total)
+        self.by_ip = RowIndex(self.ips.__getitem__, hash_int, capacity=total)
+        self.prev_same_ip = Column('I')
+        self.prev_same_ip.tail = array('I', [self.NO_ROW]) * total
+        
+        usernames, ips, prev_same_ip = self.by_username, self.by_ip, self.prev_same_ip.tail
+        for row in range(total):
+            username = self.username_of(row)
+            slot = usernames.find_slot(usernames.table, username, hash_name(username))
+            if usernames.table[slot] == self.NO_ROW:
+                usernames.table[slot] = row
+                usernames.size += 1
+            
+            packed = self.ips[row]
+            slot = ips.find_slot(ips.table, packed, hash_int(packed))
+            if ips.table[slot] == self.NO_ROW:
+                ips.size += 1
+            else:
+                prev_same_ip[row] = ips.table[slot]
+            ips.table[slot] = row
+    
+    def to_dict(self, row):
+        return {
+            'username': self.username_of(row),
+            'timestamp': datetime.fromtimestamp(self.timestamps[row]).strftime(self.TIME_FORMAT),
+            'ip': self.unpack_ip(self.ips[row]),
+            'rank': row + 1,
+            'latency': f"{self.latencies[row]:.2f}ms"
+        }
+    
+    def slice(self, start, stop):
+        return [self.to_dict(row) for row in range(start, min(stop, len(self)))]
+    
+    def find(self, username):
+        """Legacy dict of the winner with this username, or None"""
+        row = self.by_username.get(username)
+        return None if row is None else self.to_dict(row)
+    
+    def ranks_for_ip(self, ip):
+        ranks = []
+        packed = self.pack_ip(ip, add=False)
+        row = None if packed is None else self.by_ip.get(packed)
+        while row is not None and row != self.NO_ROW:
+            ranks.append(row + 1)
+            row = self.prev_same_ip[row]
+        return ranks[::-1]
+    
+    def capture_indexes(self):
+        """Point-in-time copy of both index tables, caller holds the winners lock"""
+        self.by_username.finish_migration()
+        self.by_ip.finish_migration()
+        return (len(self), array('I', bytes(self.by_username.table)), self.by_username.size,
+                array('I', bytes(self.by_ip.table)), self.by_ip.size)
+    
+    def write_json(self, f, count, total_pings):
+        """Stream the first count winners in the legacy JSON layout, one winner per line"""
+        f.write('{\n  "winners": [')
+        for start in range(0, count, 10000):
+            rows = self.slice(start, min(start + 10000, count))
+            f.write(("," if start else "") + ",".join("\n    " + json.dumps(w) for w in rows))
+        f.write(f'\n  ],\n  "total_pings": {total_pings}\n}}\n')
+    
+    def write_binary(self, f, captured, total_pings):
+        """Write a binary snapshot of the rows covered by captured (see capture_indexes)"""
+        count, username_index, username_keys, ip_index, ip_keys = captured
+        names_end = self.name_ends[count - 1] if count else 0
+        base_len = len(self.name_base)
+        # Addresses added after the capture are harmless, no written row refers to them
+        ip6_count = len(self.ip6_lo)
+        sections = {
+            'names': [self.name_base[:min(names_end, base_len)], self.name_tail[:max(0, names_end - base_len)]],
+            'name_ends': list(self.name_ends.chunks(count)),
+            'timestamps': list(self.timestamps.chunks(count)),
+            'latencies': list(self.latencies.chunks(count)),
+            'ips': list(self.ips.chunks(count)),
+            'prev_same_ip': list(self.prev_same_ip.chunks(count)),
+            'ip6_hi': list(self.ip6_hi.chunks(ip6_count)),
+            'ip6_lo': list(self.ip6_lo.chunks(ip6_count)),
+            'username_index': [username_index],
+            'ip_index': [ip_index]
+        }
+        
+        offset = self.HEADER.size + self.SECTION.size * len(self.SECTIONS)
+        table = []
+        for name in self.SECTIONS:
+            length = sum(memoryview(chunk).nbytes for chunk in sections[name])
+            table.append((offset, length))
+            offset += (length + 7) & ~7  # keep every section 8-byte aligned
+        
+        f.write(self.HEADER.pack(self.MAGIC, self.VERSION, 0, count, total_pings, username_keys, ip_keys))
+        for entry in table:
+            f.write(self.SECTION.pack(*entry))
+        for name, (_, length) in zip(self.SECTIONS, table):
+            for chunk in sections[name]:
+                f.write(chunk)
+            f.write(b'\0' * (((length + 7) & ~7) - length))
+    
+    @classmethod
+    def load_binary(cls, path, map_file=True):
+        """Open a binary snapshot, returns (store, total_pings)"""
+        with open(path, 'rb') as f:
+            if map_file:
+                # Copy-on-write mapping: index tables stay writable, the file is never modified
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+            else:
+                data = f.read()
+        
+        view = memoryview(data)
+        magic, version, _, count, total_pings, username_keys, ip_keys = cls.HEADER.unpack_from(view, 0)
+        if magic != cls.MAGIC or version not in (1, cls.VERSION):
+            raise ValueError(f"{path} is not a version 1 or {cls.VERSION} P2W snapshot")
+        
+        sections = {}
+        for i, name in enumerate(cls.SECTIONS if version == cls.VERSION else cls.SECTIONS_V1):
+            offset, length = cls.SECTION.unpack_from(view, cls.HEADER.size + i * cls.SECTION.size)
+            if offset + length > len(view):
+                raise ValueError(f"{path} is truncated")
+            section = view[offset:offset + length]
+            if name in cls.TYPECODES:
+                # cast() would raise TypeError, the caller only expects ValueError for a bad file
+                if length % struct.calcsize(cls.TYPECODES[name]):
+                    raise ValueError(f"{path} has a damaged {name} section")
+                section = section.cast(cls.TYPECODES[name])
+                if not map_file:
+                    section = array(cls.TYPECODES[name], section)
+            sections[name] = section
+        
+        store = cls()
+        store.mapping = data if map_file else None
+        store.name_base = sections['names'] if map_file else bytes(sections['names'])
+        for name in ('name_ends', 'timestamps', 'latencies', 'ips', 'prev_same_ip'):
+            setattr(store, name, Column(cls.TYPECODES[name], sections[name]))
+        store.by_username = RowIndex(store.username_of, hash_name, table=sections['username_index'], size=username_keys)
+        store.by_ip = RowIndex(store.ips.__getitem__, hash_int, table=sections['ip_index'], size=ip_keys)
+        if version == cls.VERSION:
+            store.ip6_hi = Column('Q', sections['ip6_hi'])
+            store.ip6_lo = Column('Q', sections['ip6_lo'])
+            store.ip6_ids = RowIndex(store.ip6_of, hash_ip6, capacity=len(store.ip6_lo))
+            for ip_id in range(len(store.ip6_lo)):
+                store.ip6_ids.put(store.ip6_of(ip_id), ip_id)
+        else:
+            store.upgrade_v1_ips(bytes(sections['other_ips']).decode('utf-8'))
+        return store, total_pings
+    
+    def upgrade_v1_ips(self, other_ips):
+        """Pack the text addresses of a version 1 snapshot, rows only change if one of them wasn't IPv6"""
+        packed = [self.pack_ip(ip) for ip in other_ips.split("\n")] if other_ips else []
+        if all(value == self.IP6_BASE + i for i, value in enumerate(packed)):
+            return
+        self.ips = Column('Q', array('Q', (value if value < self.IP6_BASE else packed[value - self.IP6_BASE]
+                                           for value in (self.ips[row] for row in range(len(self))))))
+        self.rebuild_indexes()
+
 
 class P2WServer:
-    def __init__(self, port=5555):
+    # Metric labels, anything else is counted as UNKNOWN to keep the label set bounded
+    COMMANDS = frozenset(("GET_STATS", "GET_LEADERBOARD", "GET_LEADERBOARD_AROUND", "GET_LEADERBOARD_USER",
+                          "CONNECT", "HEARTBEAT", "DISCONNECT", "P2W_PING", "RTT_PROBE", "ADMIN"))
+    ADMIN_IPS = ("127.0.0.1", "::1")
+    ERROR_RESPONSES = ("INVALID_REQUEST", "INVALID_USERNAME", "RATE_LIMITED")
+    
+    def __init__(self, port=5555, start_threads=True, headless=False):
         self.port = port
+        self.headless = headless
         self.config_file = "server_config.json"
-        self.load_config()
+        config_note = self.load_config()
+        self.log = self.create_log()
+        # The config decides where the log goes, so this one is only recorded now
+        self.log.emit("config", config_note, file=self.config_file, detail=config_note)
         
-        self.winners = []
+        self.winners = WinnerStore()
         self.winners_file = f"winners_{port}.json"
+        self.binary_file = f"winners_{port}.p2wb"
+        self.journal_file = f"winners_{port}.journal"
         self.connected_players = {}
-        self.ip_last_ping = {}
+        # Deadlines for presence entries, only expired ones are touched
+        self.player_expiry = TimerWheel()
         self.ip_blacklist = set()
         self.total_pings = 0
         self.total_connections = 0
         self.server_start_time = time.time()
-        self.lock = threading.RLock()
+        # Independent locks so heartbeats, rate limiting, leaderboard reads
+        # and disk I/O don't queue behind each other
+        self.metrics = Metrics()
+        self.metrics_url = None
+        self.slow_requests = SlowRequestLog(self.config['slow_request_ms'], self.config['slow_request_buffer'],
+                                            self.config['slow_request_tracing'])
+        self.profiler = SamplingProfiler(self.config['profile_interval_ms'] / 1000)
+        self.winners_lock = TimedLock(threading.RLock(), "winners", self.metrics)
+        self.players_lock = TimedLock(threading.Lock(), "players", self.metrics)
+        self.counters_lock = TimedLock(threading.Lock(), "counters", self.metrics)
         self.last_backup = time.time()
+        # Incremental backup chain, the first backup of a run is always a checkpoint
+        self.backup_lock = threading.Lock()
+        self.backup_checkpoint = None
+        self.backup_increments = 0
+        self.backup_rank = 0
+        self.backup_pings = None
+        
+        # Stats and new winners pushed to SUBSCRIBEd connections
+        self.publisher = self.create_publisher()
+        
+        # Pre-encoded GET_STATS / GET_LEADERBOARD responses
+        self.cache_lock = TimedLock(threading.Lock(), "cache", self.metrics)
+        self.page_cache = OrderedDict()
+        self.stats_cache = None
+        
+        self.rate_limiter = TokenBucketLimiter([
+            (lambda ip: ip, self.config['rate_limit_burst'], self.config['rate_limit_seconds']),
+            (subnet_of, self.config['subnet_rate_limit_burst'], self.config['subnet_rate_limit_seconds'])
+        ], self.config['rate_limit_max_buckets'])
         
         self.connection_semaphore = threading.Semaphore(self.config['max_connections'])
-        self.rate_limit_window = deque(maxlen=10000)
+        # Persistent sessions last as long as the player stays, they get their own cap (threaded mode)
+        self.stream_semaphore = threading.Semaphore(self.config['max_stream_connections'])
+        self.active_connections = 0
         
-        # Write queue to prevent JSON corruption
+        # Write queue to prevent JSON corruption, winners are appended to a
+        # journal and periodically compacted into the winners snapshot
         self.save_queue = []
         self.save_lock = threading.Lock()
+        self.save_ready = threading.Condition(self.save_lock)
         self.save_pending = False
+        self.journal_lock = threading.Lock()
+        self.journal = None
+        self.journal_records = 0
+        self.journal_pings = None
+        self.journal_dirty = False
+        self.last_fsync = time.time()
+        self.last_compaction = time.time()
+        
+        # Wins are numbered as they are queued, durable_seq is the last one
+        # known to be fsynced. Non-async durability modes hold WIN replies until then
+        self.queued_seq = 0
+        self.written_seq = 0
+        self.durable_seq = 0
+        self.durable_cond = threading.Condition()
+        self.unsynced_records = 0
+        self.commit_count = 0
+        self.committed_records = 0
+        self.max_commit_batch = 0
+        self.fsync_seconds = 0.0
+        self.max_fsync_seconds = 0.0
+        
+        self.workers = []
         
         self.load_winners()
         self.load_blacklist()
         
-        threading.Thread(target=self.display_stats, daemon=True).start()
+        if start_threads:
+            self.start_background_threads()
+    
+    def create_log(self):
+        log_file = self.config['log_file']
+        stream = open(log_file, 'a', buffering=1 << 16) if log_file else None
+        return EventLog(stream, json_lines=self.headless, sample_every=self.config['log_sample_every'],
+                        flush_interval=self.config['log_flush_interval_seconds'])
+    
+    def create_publisher(self):
+        return Publisher(self.respond, self.config['push_interval_seconds'], self.config['leaderboard_page_size'],
+                         self.config['push_max_backlog_bytes'])
+    
+    def start_background_threads(self):
+        threading.Thread(target=self.log.run, daemon=True).start()
+        threading.Thread(target=self.log_stats if self.headless else self.display_stats, daemon=True).start()
         threading.Thread(target=self.auto_backup, daemon=True).start()
-        threading.Thread(target=self.cleanup_old_connections, daemon=True).start()
-        threading.Thread(target=self.cleanup_inactive_players, daemon=True).start()
+        threading.Thread(target=self.expire_entries, daemon=True).start()
         threading.Thread(target=self.process_save_queue, daemon=True).start()
+        if self.config['metrics_enabled']:
+            self.start_metrics()
+    
+    def start_metrics(self):
+        # Defaults to the game port + 1000 so several servers on one host don't collide
+        port = self.config['metrics_port'] or self.port + 1000
+        try:
+            serve_metrics(self.config['metrics_host'], port, self.render_metrics)
+            self.metrics_url = f"http://{self.config['metrics_host']}:{port}/metrics"
+        except OSError as e:
+            self.log.emit("metrics_error", f"WARNING: Metrics endpoint not started on port {port}: {e}", port=port, error=str(e))
+    
+    def render_metrics(self):
+        commits = self.commit_count
+        return self.metrics.render([
+            ("p2w_winners", "Winners on the leaderboard", "gauge", len(self.winners)),
+            ("p2w_players_online", "Players with a live presence entry", "gauge", len(self.connected_players)),
+            ("p2w_pings_total", "Pings received", "counter", self.total_pings),
+            ("p2w_connections_total", "Connections accepted", "counter", self.total_connections),
+            ("p2w_open_connections", "Connections currently open (asyncio mode)", "gauge", self.active_connections),
+            ("p2w_push_subscribers", "Connections subscribed to pushes", "gauge", len(self.publisher)),
+            ("p2w_push_frames_total", "Stats and winners frames pushed", "counter", self.publisher.frames_sent),
+            ("p2w_rate_limit_buckets", "Tracked rate limit buckets", "gauge", len(self.rate_limiter)),
+            ("p2w_journal_commits_total", "Journal fsyncs that committed wins", "counter", commits),
+            ("p2w_journal_committed_wins_total", "Wins committed by those fsyncs", "counter", self.committed_records),
+            ("p2w_journal_fsync_seconds_total", "Time spent in journal fsync", "counter", f"{self.fsync_seconds:.6f}"),
+            ("p2w_journal_fsync_max_seconds", "Slowest journal fsync", "gauge", f"{self.max_fsync_seconds:.6f}"),
+        ])
     
     def load_config(self):
+        """Read the config, filling in missing keys, returns a message saying where it came from"""
         default_config = {
             "rate_limit_enabled": True,
             "rate_limit_seconds": 10,
             "max_connections": 1000,
+            "max_stream_connections": 4096,
             "backup_interval_seconds": 300,
+            "backup_increments_per_checkpoint": 12,
+            "backup_keep_checkpoints": 3,
             "player_timeout_seconds": 30,
             "max_username_length": 32,
-            "stats_display_interval": 4
+            "stats_display_interval": 4,
+            "server_mode": "threaded",
+            "async_max_connections": 65536,
+            "stream_idle_timeout_seconds": 60,
+            "push_interval_seconds": 1.0,
+            "push_max_backlog_bytes": 1048576,
+            "snapshot_format": "json",
+            "max_frame_bytes": 4096,
+            "journal_fsync_interval_seconds": 1.0,
+            "durability_mode": "async",
+            "log_file": None,
+            "log_flush_interval_seconds": 0.25,
+            "log_sample_every": {"heartbeat": 100},
+            "slow_request_tracing": False,
+            "slow_request_ms": 50,
+            "slow_request_buffer": 256,
+            "admin_enabled": True,
+            "profile_interval_ms": 5,
+            "metrics_enabled": True,
+            "metrics_host": "127.0.0.1",
+            "metrics_port": None,
+            "group_commit_window_ms": 2,
+            "journal_compact_records": 10000,
+            "journal_compact_interval_seconds": 300,
+            "leaderboard_page_size": 100,
+            "leaderboard_cache_pages": 256,
+            "stats_cache_seconds": 1.0,
+            "rate_limit_burst": 1,
+            "subnet_rate_limit_burst": 20,
+            "subnet_rate_limit_seconds": 1,
+            "rate_limit_max_buckets": 100000,
+            "worker_processes": 4,
+            "worker_server_mode": "asyncio",
+            "coordinator_threads": 32,
+            "worker_reply_timeout_seconds": 10
         }
         
         if path.exists(self.config_file):
@@ -60,71 +1054,233 @@ class P2WServer:
                 for key, value in default_config.items():
                     if key not in self.config:
                         self.config[key] = value
-                print(f"Loaded config from {self.config_file}")
+                return f"Loaded config from {self.config_file}"
             except:
-                print(f"Error loading config, using defaults")
                 self.config = default_config
-        else:
-            self.config = default_config
-            self.save_config()
-            print(f"Created default config at {self.config_file}")
+                return f"Error loading config, using defaults"
+        self.config = default_config
+        return self.save_config() or f"Created default config at {self.config_file}"
     
     def save_config(self):
+        """Write the config, returns an error message if that failed"""
         try:
             with open(self.config_file, 'w') as f:
                 json.dump(self.config, f, indent=2)
         except Exception as e:
-            print(f"Error saving config: {e}")
+            return f"Error saving config: {e}"
+        return None
         
     def load_winners(self):
+        self.winners = WinnerStore()
+        self.total_pings = 0
+        # Whichever snapshot was written last is current, the other one is left
+        # over from before snapshot_format was changed
+        snapshots = [f for f in (self.winners_file, self.binary_file) if path.exists(f)]
+        latest = max(snapshots, key=path.getmtime, default=None)
+        if latest:
+            try:
+                # Windows can't replace a file that is mapped, read it into memory there
+                self.winners, self.total_pings = self.read_snapshot(latest, map_file=os.name != 'nt')
+            except (json.JSONDecodeError, ValueError, struct.error) as e:
+                self.log.emit("snapshot_corrupted", f"ERROR: Corrupted winners file ({e}). Creating backup...",
+                              file=latest, error=str(e))
+                try:
+                    shutil.copy(latest, f"{latest}.corrupted")
+                except:
+                    pass
+                self.winners = WinnerStore()
+                self.total_pings = 0
+        self.replay_journal()
+    
+    def read_snapshot(self, snapshot_file, map_file=False):
+        """Load a JSON or binary snapshot, returns (winners, total_pings)"""
+        if snapshot_file.endswith('.p2wb'):
+            return WinnerStore.load_binary(snapshot_file, map_file=map_file)
+        with open(snapshot_file, 'r') as f:
+            data = json.load(f)
+        winners = WinnerStore()
+        winners.extend_legacy(data.get('winners', []))
+        return winners, data.get('total_pings', 0)
+    
+    def replay_journal(self):
+        """Apply journal records written since the last snapshot"""
         try:
-            with open(self.winners_file, 'r') as f:
-                data = json.load(f)
-                self.winners = data.get('winners', [])
-                self.total_pings = data.get('total_pings', 0)
+            with open(self.journal_file, 'rb') as f:
+                data = f.read()
         except FileNotFoundError:
-            self.winners = []
-            self.total_pings = 0
-        except json.JSONDecodeError:
-            print(f"ERROR: Corrupted winners file. Creating backup...")
+            return
+        
+        complete = data.rfind(b"\n") + 1
+        if complete < len(data):
+            # A torn last record from a crash. Cut it off before anything is appended,
+            # or the next record lands on the same line and is lost with it
+            with open(self.journal_file, 'r+b') as f:
+                f.truncate(complete)
+                f.flush()
+                os.fsync(f.fileno())
+            self.log.emit("journal_truncated", f"WARNING: Dropped {len(data) - complete} bytes of a torn journal record",
+                          bytes=len(data) - complete)
+        lines = data[:complete].decode('utf-8', errors='replace').splitlines(keepends=True)
+        self.journal_records += self.apply_records(lines)
+        if lines:
+            self.log.emit("journal_replayed", f"Replayed {len(lines)} journal records", records=len(lines))
+    
+    def apply_records(self, lines):
+        """Apply journal-format lines to the winners, returns how many were readable"""
+        applied = 0
+        for line in lines:
             try:
-                shutil.copy(self.winners_file, f"{self.winners_file}.corrupted")
-            except:
-                pass
-            self.winners = []
-            self.total_pings = 0
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Torn write from a crash, everything before it is intact
+                self.log.emit("journal_damaged", "WARNING: Skipping damaged journal record")
+                continue
+            applied += 1
+            winner = record.get('winner')
+            # Records already folded into the snapshot are skipped by rank
+            if winner and winner['rank'] > len(self.winners):
+                if winner['rank'] != len(self.winners) + 1:
+                    self.log.emit("journal_gap", f"WARNING: Journal gap before rank #{winner['rank']}", rank=winner['rank'])
+                self.winners.append_legacy(winner)
+            if 'total_pings' in record:
+                self.total_pings = max(self.total_pings, record['total_pings'])
+        return applied
+    
+    def save_winners(self, winner_data=None):
+        """Queue a save operation instead of writing directly, returns the win's sequence number"""
+        with self.save_ready:
+            self.save_pending = True
+            if winner_data:
+                self.save_queue.append(winner_data)
+                self.queued_seq += 1
+                # Only wins wake the writer, ping counts ride along with the next write
+                self.save_ready.notify()
+                return self.queued_seq
+        return None
     
-    def save_winners(self):
-        """Queue a save operation instead of writing directly"""
-        with self.save_lock:
-            if not self.save_pending:
-                self.save_pending = True
-                self.save_queue.append(time.time())
+    def wait_durable(self, seq):
+        """Block until win seq is fsynced according to durability_mode"""
+        mode = self.config['durability_mode']
+        if mode == "sync":
+            # Flushing under the journal lock also covers a batch another thread is already writing
+            self.flush_journal(force_fsync=True)
+        elif mode == "group":
+            with self.durable_cond:
+                if not self.durable_cond.wait_for(lambda: self.durable_seq >= seq, timeout=5):
+                    self.log.emit("commit_timeout", f"WARNING: Win #{seq} not committed after 5s, replying anyway", seq=seq)
     
     def process_save_queue(self):
-        """Process save queue - only one write at a time"""
+        """Write queued winners as they arrive - only one write at a time"""
         while True:
-            time.sleep(0.1)  # Check queue every 100ms
+            with self.save_ready:
+                if not self.save_queue:
+                    # Woken by the next win, the timeout covers ping counts, fsync and compaction
+                    self.save_ready.wait(0.1)
+                has_wins = bool(self.save_queue)
             
-            with self.save_lock:
-                if self.save_pending:
-                    self.save_pending = False
-                    self.save_queue.clear()
-                else:
-                    continue
-            
-            # Actually write to file (outside lock so we don't block queue)
             try:
-                with self.lock:
-                    temp_file = f"{self.winners_file}.tmp"
-                    with open(temp_file, 'w') as f:
-                        json.dump({
-                            'winners': self.winners,
-                            'total_pings': self.total_pings
-                        }, f, indent=2)
-                    shutil.move(temp_file, self.winners_file)
+                mode = self.config['durability_mode']
+                if mode == "group" and has_wins:
+                    # Let concurrent wins join this commit
+                    time.sleep(self.config['group_commit_window_ms'] / 1000)
+                self.flush_journal(force_fsync=mode != "async" and has_wins)
+                
+                if self.journal_records and (
+                        self.journal_records >= self.config['journal_compact_records'] or
+                        time.time() - self.last_compaction >= self.config['journal_compact_interval_seconds']):
+                    self.compact_journal()
             except Exception as e:
-                print(f"ERROR saving winners: {e}")
+                self.log.emit("save_error", f"ERROR saving winners: {e}", error=str(e))
+    
+    def flush_journal(self, force_fsync=False):
+        """Append queued winners to the journal, fsyncing at most once per interval unless forced"""
+        with self.journal_lock:
+            with self.save_lock:
+                pending = self.save_pending
+                records = self.save_queue
+                seq = self.queued_seq
+                self.save_queue = []
+                self.save_pending = False
+            
+            if pending:
+                if self.journal is None:
+                    self.journal = open(self.journal_file, 'a')
+                
+                lines = [json.dumps({'winner': winner}) + "\n" for winner in records]
+                total_pings = self.total_pings
+                if total_pings != self.journal_pings:
+                    lines.append(json.dumps({'total_pings': total_pings}) + "\n")
+                    self.journal_pings = total_pings
+                
+                if lines:
+                    self.journal.write(''.join(lines))
+                    self.journal.flush()
+                    self.journal_records += len(lines)
+                    self.unsynced_records += len(records)
+                    self.journal_dirty = True
+            self.written_seq = seq
+            
+            if self.journal_dirty and (force_fsync or time.time() - self.last_fsync >= self.config['journal_fsync_interval_seconds']):
+                start = time.perf_counter()
+                os.fsync(self.journal.fileno())
+                elapsed = time.perf_counter() - start
+                self.journal_dirty = False
+                self.last_fsync = time.time()
+                
+                if self.unsynced_records:
+                    self.commit_count += 1
+                    self.committed_records += self.unsynced_records
+                    self.max_commit_batch = max(self.max_commit_batch, self.unsynced_records)
+                    self.unsynced_records = 0
+                    self.fsync_seconds += elapsed
+                    self.max_fsync_seconds = max(self.max_fsync_seconds, elapsed)
+            
+            if not self.journal_dirty and self.durable_seq != self.written_seq:
+                with self.durable_cond:
+                    self.durable_seq = self.written_seq
+                    self.durable_cond.notify_all()
+    
+    def write_snapshot(self, target_file, binary=False):
+        """Write the full winners state to target_file atomically"""
+        if binary:
+            # The index tables are copied under the lock, the columns after it
+            with self.winners_lock:
+                captured = self.winners.capture_indexes()
+            total = captured[0]
+        else:
+            # Rows never change once written, so everything below this count can be
+            # read without holding the winners lock
+            total = len(self.winners)
+        with self.counters_lock:
+            total_pings = self.total_pings
+        
+        temp_file = f"{target_file}.tmp"
+        with open(temp_file, 'wb' if binary else 'w') as f:
+            if binary:
+                self.winners.write_binary(f, captured, total_pings)
+            else:
+                self.winners.write_json(f, total, total_pings)
+            f.flush()
+            os.fsync(f.fileno())
+        shutil.move(temp_file, target_file)
+        return total
+    
+    def compact_journal(self):
+        """Fold the journal into a fresh snapshot and start an empty journal"""
+        self.flush_journal(force_fsync=True)
+        with self.journal_lock:
+            # Winners queued after the snapshot copy land in the new journal,
+            # duplicates are harmless because replay skips by rank
+            if self.config['snapshot_format'] == "binary":
+                self.write_snapshot(self.binary_file, binary=True)
+            else:
+                self.write_snapshot(self.winners_file)
+            if self.journal:
+                self.journal.close()
+            self.journal = open(self.journal_file, 'w')
+            self.journal_records = 0
+            self.journal_pings = None
+            self.last_compaction = time.time()
     
     def load_blacklist(self):
         try:
@@ -145,34 +1301,136 @@ class P2WServer:
                 self.backup_data()
                 self.last_backup = time.time()
     
-    def backup_data(self):
+    def backup_data(self, checkpoint=False):
+        """Back up winners added since the previous backup, with a full checkpoint every few increments.
+        
+        A checkpoint is a regular snapshot (backup_<port>_<ts>_<seq>.json or .p2wb).
+        An increment (backup_<port>_<ts>_<seq>.inc) is a header line naming its
+        checkpoint followed by journal-format records, so a restore loads the
+        checkpoint and replays the increments after it in order.
+        """
         try:
-            backup_file = f"backup_{self.port}_{int(time.time())}.json"
-            shutil.copy(self.winners_file, backup_file)
-            print(f"Backup created: {backup_file}")
+            with self.backup_lock:
+                total = len(self.winners)
+                with self.counters_lock:
+                    total_pings = self.total_pings
+                
+                if (checkpoint or self.backup_checkpoint is None or
+                        self.backup_increments >= self.config['backup_increments_per_checkpoint']):
+                    binary = self.config['snapshot_format'] == "binary"
+                    backup_file = self.backup_file_name('p2wb' if binary else 'json')
+                    self.backup_rank = self.write_snapshot(backup_file, binary=binary)
+                    self.backup_checkpoint = backup_file
+                    self.backup_increments = 0
+                    self.backup_pings = total_pings
+                    self.prune_backups()
+                elif total == self.backup_rank and total_pings == self.backup_pings:
+                    # Nothing happened since the last backup
+                    return
+                else:
+                    backup_file = self.backup_file_name('inc')
+                    header = {'checkpoint': self.backup_checkpoint, 'first_rank': self.backup_rank + 1, 'last_rank': total}
+                    # Rows below total never change, no lock needed to read them
+                    lines = [json.dumps(header) + "\n"]
+                    lines += [json.dumps({'winner': winner}) + "\n" for winner in self.winners.slice(self.backup_rank, total)]
+                    lines.append(json.dumps({'total_pings': total_pings}) + "\n")
+                    
+                    temp_file = f"{backup_file}.tmp"
+                    with open(temp_file, 'w') as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        os.fsync(f.fileno())
+                    shutil.move(temp_file, backup_file)
+                    self.backup_rank = total
+                    self.backup_increments += 1
+                    self.backup_pings = total_pings
+            self.log.emit("backup", f"Backup created: {backup_file}", file=backup_file)
         except Exception as e:
-            print(f"ERROR during backup: {e}")
+            self.log.emit("error", f"ERROR during backup: {e}", error=str(e))
     
-    def cleanup_old_connections(self):
-        while True:
-            time.sleep(60)
-            current_time = time.time()
-            with self.lock:
-                expired = [ip for ip, ts in self.ip_last_ping.items() 
-                          if current_time - ts > 60]
-                for ip in expired:
-                    del self.ip_last_ping[ip]
+    def backup_file_name(self, extension):
+        # The sequence number orders the chain, even within one second or after the clock went back
+        seq = max((seq for seq, _, _ in self.list_backups()), default=0) + 1
+        return f"backup_{self.port}_{int(time.time())}_{seq:06d}.{extension}"
+    
+    def list_backups(self):
+        """(sequence, timestamp, file) for every backup of this port, oldest first"""
+        # Backups named before sequence numbers were added have none, they all come first
+        pattern = re.compile(rf'^backup_{self.port}_(\d+)(?:_(\d+))?\.(json|p2wb|inc)$')
+        backups = []
+        for name in os.listdir('.'):
+            match = pattern.match(name)
+            if match:
+                backups.append((int(match.group(2) or 0), int(match.group(1)), name))
+        return sorted(backups)
     
-    def cleanup_inactive_players(self):
+    def prune_backups(self):
+        """Keep the newest backup_keep_checkpoints checkpoints and the increments that depend on them"""
+        backups = self.list_backups()
+        checkpoints = [i for i, (_, _, name) in enumerate(backups) if not name.endswith('.inc')]
+        keep = self.config['backup_keep_checkpoints']
+        if len(checkpoints) <= keep:
+            return
+        for _, _, name in backups[:checkpoints[-keep]]:
+            try:
+                os.remove(name)
+            except OSError as e:
+                self.log.emit("backup_error", f"WARNING: Could not remove old backup {name}: {e}", file=name, error=str(e))
+    
+    def restore_backup(self, until=None):
+        """Rebuild the winners from the newest backup chain (or the newest one at or before until) and make it current"""
+        backups = [name for _, ts, name in self.list_backups() if until is None or ts <= until]
+        checkpoints = [i for i, name in enumerate(backups) if not name.endswith('.inc')]
+        if not checkpoints:
+            self.log.emit("restore_failed", "No backup checkpoint found", until=until)
+            return False
+        
+        start = checkpoints[-1]
+        checkpoint = backups[start]
+        self.winners, self.total_pings = self.read_snapshot(checkpoint)
+        increments = 0
+        for name in backups[start + 1:]:
+            with open(name, 'r') as f:
+                header = json.loads(f.readline())
+                if header.get('checkpoint') != checkpoint or header.get('first_rank') != len(self.winners) + 1:
+                    self.log.emit("restore_chain_broken",
+                                  f"WARNING: {name} does not continue {checkpoint}, stopping at rank #{len(self.winners)}",
+                                  file=name, checkpoint=checkpoint, rank=len(self.winners))
+                    break
+                self.apply_records(f.readlines())
+            increments += 1
+        
+        # The journal belongs to the state being replaced, keep it aside rather than replay it
+        if path.exists(self.journal_file):
+            shutil.move(self.journal_file, f"{self.journal_file}.pre-restore")
+        binary = self.config['snapshot_format'] == "binary"
+        self.write_snapshot(self.binary_file if binary else self.winners_file, binary=binary)
+        self.log.emit("restored", f"Restored {len(self.winners)} winners from {checkpoint} and {increments} increment(s)",
+                      winners=len(self.winners), checkpoint=checkpoint, increments=increments)
+        
+        # Later increments must not chain onto backups from before the restore
+        self.backup_data(checkpoint=True)
+        return True
+    
+    def expire_entries(self):
+        """Drop rate-limit entries and inactive players as soon as their deadline passes"""
         while True:
-            time.sleep(10)
+            time.sleep(self.player_expiry.resolution)
             current_time = time.time()
-            with self.lock:
-                inactive = [user for user, ts in self.connected_players.items() 
-                           if current_time - ts > self.config['player_timeout_seconds']]
+            
+            self.rate_limiter.expire(current_time)
+            
+            with self.players_lock:
+                inactive = self.player_expiry.expire(current_time)
                 for user in inactive:
                     del self.connected_players[user]
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] {user} removed (inactive)")
+            for user in inactive:
+                self.log.emit("player_expired", f"{user} removed (inactive)", username=user)
+    
+    def touch_player(self, username, now):
+        """Mark a player as seen, caller holds self.players_lock"""
+        self.connected_players[username] = now
+        self.player_expiry.schedule(username, now + self.config['player_timeout_seconds'])
     
     def validate_username(self, username):
         if not username or len(username) > self.config['max_username_length']:
@@ -182,199 +1440,874 @@ class P2WServer:
         return True
     
     def check_rate_limit(self, ip):
-        current_time = time.time()
-        with self.lock:
-            if ip in self.ip_last_ping:
-                time_since_last = current_time - self.ip_last_ping[ip]
-                if time_since_last < self.config['rate_limit_seconds']:
-                    return False, self.config['rate_limit_seconds'] - time_since_last
-        return True, 0
+        """Check and consume a ping token for ip and its subnet in one step"""
+        return self.rate_limiter.consume(ip)
+    
+    def process_command(self, data, ip, rtt=None):
+        """Run a single protocol command and return the response string.
+        
+        rtt is the round trip in ms the server measured on the connection
+        the command came from, None if it couldn't.
+        """
+        if data == "GET_STATS":
+            return self.stats_response()
+        
+        elif data == "GET_LEADERBOARD":
+            return self.leaderboard_response(0, self.config['leaderboard_page_size'])
+        
+        elif data.startswith("GET_LEADERBOARD:"):
+            # GET_LEADERBOARD:<offset>:<limit>
+            try:
+                offset, limit = (int(x) for x in data.split(":")[1:3])
+            except ValueError:
+                return "INVALID_REQUEST"
+            return self.leaderboard_response(offset, limit)
+        
+        elif data.startswith("GET_LEADERBOARD_AROUND:"):
+            # GET_LEADERBOARD_AROUND:<rank>[:<radius>]
+            try:
+                args = [int(x) for x in data.split(":")[1:3]]
+            except ValueError:
+                return "INVALID_REQUEST"
+            rank = args[0]
+            radius = args[1] if len(args) > 1 else 10
+            radius = max(0, min(radius, self.config['leaderboard_page_size'] // 2))
+            return self.leaderboard_response(rank - 1 - radius, 2 * radius + 1)
+        
+        elif data.startswith("GET_LEADERBOARD_USER:"):
+            username = data.split("GET_LEADERBOARD_USER:", 1)[1].strip()
+            with self.winners_lock:
+                winner = self.winners.find(username)
+                total = len(self.winners)
+            return json.dumps({'winner': winner, 'total': total})
+        
+        elif data.startswith("CONNECT:"):
+            username = data.split("CONNECT:", 1)[1].strip()
+            
+            if not self.validate_username(username):
+                return "INVALID_USERNAME"
+            
+            with self.players_lock:
+                self.touch_player(username, time.time())
+            self.log.emit("connect", f"{username} connected from {ip}", username=username, ip=ip)
+            return "CONNECTED"
+        
+        elif data.startswith("HEARTBEAT:"):
+            username = data.split("HEARTBEAT:", 1)[1].strip()
+            with self.players_lock:
+                if username in self.connected_players:
+                    self.touch_player(username, time.time())
+            self.log.emit("heartbeat", f"{username} heartbeat", username=username, ip=ip)
+            return "OK"
+        
+        elif data.startswith("DISCONNECT:"):
+            username = data.split("DISCONNECT:", 1)[1].strip()
+            with self.players_lock:
+                self.connected_players.pop(username, None)
+                self.player_expiry.cancel(username)
+            self.log.emit("disconnect", f"{username} disconnected", username=username, ip=ip)
+            return "DISCONNECTED"
+        
+        elif data.startswith("ADMIN:"):
+            return self.admin_command(data.split("ADMIN:", 1)[1].strip(), ip)
+        
+        elif data == "RTT_PROBE" or data.startswith("RTT_PROBE:"):
+            # One-shot connections can't be sampled, persistent ones are answered by stream_command
+            return f"RTT_ACK::{time.perf_counter_ns()}"
+        
+        elif data.startswith("P2W_PING:"):
+            parts = data.split("P2W_PING:", 1)[1].split("|")
+            username = parts[0].strip()
+            
+            # Checked first so a malformed ping doesn't spend the address's token
+            if not self.validate_username(username):
+                return "INVALID_USERNAME"
+            
+            if self.config['rate_limit_enabled']:
+                can_ping, wait_time = self.check_rate_limit(ip)
+                if not can_ping:
+                    return f"RATE_LIMITED:{wait_time:.1f}"
+            
+            try:
+                client_latency = float(parts[1]) if len(parts) > 1 else 0
+            except (ValueError, IndexError):
+                client_latency = 0
+            if not 0 <= client_latency < 60000:
+                client_latency = 0
+            # What the client reports is only used when the server couldn't measure it
+            latency = rtt if rtt is not None else client_latency
+            
+            with self.counters_lock:
+                self.total_pings += 1
+            
+            with self.winners_lock:
+                if username in self.winners:
+                    response = "ALREADY_WON"
+                else:
+                    rank = self.winners.append(username, time.time(), ip, latency)
+                    seq = self.save_winners(self.winners.to_dict(rank - 1))
+                    response = f"WIN:{rank}"
+            
+            if response == "ALREADY_WON":
+                self.save_winners()
+            else:
+                # Outside the winners lock so other pings keep going while this one commits
+                self.wait_durable(seq)
+                self.log.emit("win", f"NEW WINNER #{rank}: {username} ({latency:.2f}ms)",
+                              rank=rank, username=username, ip=ip, latency_ms=round(latency, 2),
+                              client_latency_ms=round(client_latency, 2), measured=rtt is not None)
+            return response
+        
+        return "INVALID_REQUEST"
+    
+    def admin_command(self, command, ip):
+        """Profiling controls, only answered for connections from this machine"""
+        if not self.config['admin_enabled'] or ip not in self.ADMIN_IPS:
+            return "INVALID_REQUEST"
+        
+        if command == "SLOW":
+            return json.dumps({'enabled': self.slow_requests.enabled, 'threshold_ms': self.config['slow_request_ms'],
+                               'requests': self.slow_requests.snapshot()})
+        elif command in ("TRACE_ON", "TRACE_OFF"):
+            self.slow_requests.enabled = command == "TRACE_ON"
+            return "OK"
+        elif command in ("RATE_LIMIT_ON", "RATE_LIMIT_OFF"):
+            # Load tests switch it off for a run, the reply says what to restore afterwards
+            was_enabled = self.config['rate_limit_enabled']
+            self.config['rate_limit_enabled'] = command == "RATE_LIMIT_ON"
+            return f"OK:{'ENABLED' if was_enabled else 'DISABLED'}"
+        elif command.startswith("PROFILE_START"):
+            parts = command.split(":")
+            if len(parts) > 1 and parts[1].isdigit() and int(parts[1]) > 0:
+                self.profiler.interval = 1 / int(parts[1])
+            return "PROFILING" if self.profiler.start() else "ALREADY_PROFILING"
+        elif command == "PROFILE_STOP":
+            if not self.profiler.running:
+                return "NOT_PROFILING"
+            profile_file, samples = self.stop_profiler()
+            return f"PROFILE_SAVED:{profile_file}:{samples}"
+        return "INVALID_REQUEST"
+    
+    def stop_profiler(self):
+        profile_file = f"profile_{self.port}_{int(time.time())}.folded"
+        samples = self.profiler.stop(profile_file)
+        self.log.emit("profile", f"Profile written to {profile_file} ({samples} samples)", file=profile_file, samples=samples)
+        return profile_file, samples
+    
+    def toggle_profiler(self, *_):
+        """SIGUSR2 handler: start sampling, or stop and write the collapsed stacks"""
+        if self.profiler.running:
+            # Writing the file can take a moment, keep it out of the signal handler
+            threading.Thread(target=self.stop_profiler, daemon=True).start()
+        else:
+            self.profiler.start()
+            self.log.emit("profile", "Profiler started")
+    
+    def trace_request(self, data, ip, started, phases):
+        """Keep the phase breakdown of a request slower than slow_request_ms"""
+        if not self.slow_requests.enabled:
+            return
+        total = time.perf_counter() - started
+        if total < self.slow_requests.threshold:
+            return
+        # respond() ran in this thread, its lock waits are carved out of the handle phase
+        waited = self.metrics.last_lock_wait()
+        phases['lock_wait'] = waited
+        phases['handle'] -= waited
+        self.slow_requests.add(data, ip, total, phases)
+    
+    def respond(self, data, ip, rtt=None):
+        """process_command as bytes, cached responses are already encoded"""
+        command = data.split(":", 1)[0]
+        if command not in self.COMMANDS:
+            command = "UNKNOWN"
+        token = self.metrics.start_request()
+        start = time.perf_counter()
+        error = "exception"
+        try:
+            response = self.process_command(data, ip, rtt)
+            if isinstance(response, bytes):
+                error = None
+                return response
+            error = response.split(":", 1)[0] if response.startswith(self.ERROR_RESPONSES) else None
+            return response.encode('utf-8')
+        finally:
+            self.metrics.finish_request(command, time.perf_counter() - start, error, token)
+    
+    async def respond_async(self, data, ip, rtt=None):
+        if data.startswith("P2W_PING:") and self.config['durability_mode'] != "async":
+            # A win may wait for fsync, keep that off the event loop
+            return await asyncio.get_running_loop().run_in_executor(None, self.respond, data, ip, rtt)
+        return self.respond(data, ip, rtt)
+    
+    def stats_response(self):
+        """GET_STATS payload, rebuilt when winners/players change or the cache ages out"""
+        key = (len(self.winners), len(self.connected_players))
+        now = time.time()
+        cached = self.stats_cache
+        if cached and cached[0] == key and now - cached[1] < self.config['stats_cache_seconds']:
+            return cached[2]
+        
+        # Each value is a single read, no lock needed for a point-in-time snapshot
+        stats = {
+            'total_winners': len(self.winners),
+            'online_players': len(self.connected_players),
+            'total_pings': self.total_pings,
+            'uptime': int(now - self.server_start_time),
+            'total_connections': self.total_connections,
+            'server_mode': self.config['server_mode']
+        }
+        payload = json.dumps(stats).encode('utf-8')
+        self.stats_cache = ((stats['total_winners'], stats['online_players']), now, payload)
+        return payload
+    
+    def leaderboard_response(self, offset, limit):
+        """One bounded page of the leaderboard, ranks never move so offsets act as cursors"""
+        limit = max(0, min(limit, self.config['leaderboard_page_size']))
+        offset = max(0, offset)
+        key = (offset, limit)
+        
+        total = len(self.winners)
+        
+        # A full page can never change, a partial tail page is valid until the next winner
+        with self.cache_lock:
+            entry = self.page_cache.get(key)
+            if entry and (entry[1] == limit or entry[2] == total):
+                self.page_cache.move_to_end(key)
+            else:
+                entry = None
+        
+        if entry is None:
+            with self.winners_lock:
+                total = len(self.winners)
+            winners = self.winners.slice(offset, min(offset + limit, total))
+            entry = (json.dumps(winners).encode('utf-8'), len(winners), total)
+            with self.cache_lock:
+                self.page_cache[key] = entry
+                self.page_cache.move_to_end(key)
+                while len(self.page_cache) > self.config['leaderboard_cache_pages']:
+                    self.page_cache.popitem(last=False)
+        
+        body, count, _ = entry
+        next_offset = offset + count
+        next_offset = str(next_offset).encode('ascii') if next_offset < total else b'null'
+        return b'{"winners": %s, "offset": %d, "total": %d, "next_offset": %s}' % (body, offset, total, next_offset)
+    
+    def stream_command(self, data, session):
+        """Commands that only exist on persistent connections, None for everything else"""
+        if data == "RTT_PROBE" or data.startswith("RTT_PROBE:"):
+            return session.rtt_probe(data[len("RTT_PROBE:"):])
+        elif data == "SUBSCRIBE" or data.startswith("SUBSCRIBE:"):
+            # SUBSCRIBE[:<winners already known>], without it winners are pushed from now on
+            since = data[len("SUBSCRIBE:"):]
+            if since and not since.isdigit():
+                return b"INVALID_REQUEST"
+            self.publisher.subscribe(session, int(since) if since else None)
+            return b"SUBSCRIBED"
+        elif data == "UNSUBSCRIBE":
+            self.publisher.unsubscribe(session)
+            return b"UNSUBSCRIBED"
+        return None
+    
+    def answer_frame(self, data, ip, session):
+        response = self.stream_command(data, session)
+        if response is None:
+            response = self.respond(data, ip, session.measured_rtt() if data.startswith("P2W_PING:") else None)
+        return response
+    
+    async def answer_frame_async(self, data, ip, session):
+        response = self.stream_command(data, session)
+        if response is None:
+            response = await self.respond_async(data, ip, session.measured_rtt() if data.startswith("P2W_PING:") else None)
+        return response
     
-    def handle_client(self, conn, addr):
+    def count_connection(self):
+        with self.counters_lock:
+            self.total_connections += 1
+    
+    def handle_client(self, conn, addr, accepted=None):
+        accepted = accepted or time.perf_counter()
         self.connection_semaphore.acquire()
+        holding_slot = True
         try:
             if addr[0] in self.ip_blacklist:
-                conn.send("BLACKLISTED".encode('utf-8'))
+                conn.sendall("BLACKLISTED".encode('utf-8'))
                 return
             
             conn.settimeout(5)
-            data = conn.recv(1024).decode('utf-8', errors='ignore').strip()
+            raw = conn.recv(1024)
+            while partial_hello(raw):
+                chunk = conn.recv(1024)
+                if not chunk:
+                    break
+                raw += chunk
+            received = time.perf_counter()
             
-            if not data:
+            if raw.startswith(STREAM_HELLO_BYTES):
+                self.count_connection()
+                # max_connections bounds requests in flight, a session that idles between
+                # heartbeats for hours must not keep one of those slots
+                self.connection_semaphore.release()
+                holding_slot = False
+                if not self.stream_semaphore.acquire(blocking=False):
+                    # Clients treat anything but STREAM_OK as "use one-shot requests"
+                    conn.sendall(encode_frame(STREAM_BUSY))
+                    return
+                try:
+                    self.serve_stream(conn, addr[0], raw[len(STREAM_HELLO_BYTES):])
+                finally:
+                    self.stream_semaphore.release()
                 return
             
-            self.total_connections += 1
+            data = raw.decode('utf-8', errors='ignore').strip()
             
-            if data == "GET_STATS":
-                with self.lock:
-                    stats = {
-                        'total_winners': len(self.winners),
-                        'online_players': len(self.connected_players),
-                        'total_pings': self.total_pings,
-                        'uptime': int(time.time() - self.server_start_time),
-                        'total_connections': self.total_connections
-                    }
-                conn.send(json.dumps(stats).encode('utf-8'))
-                return
-            
-            elif data == "GET_LEADERBOARD":
-                with self.lock:
-                    leaderboard = {'winners': self.winners[:100]}
-                conn.send(json.dumps(leaderboard).encode('utf-8'))
+            if not data:
                 return
             
-            elif data.startswith("CONNECT:"):
-                username = data.split("CONNECT:", 1)[1].strip()
-                
-                if not self.validate_username(username):
-                    conn.send("INVALID_USERNAME".encode('utf-8'))
-                    return
+            self.count_connection()
+            parsed = time.perf_counter()
+            response = self.respond(data, addr[0], tcp_rtt(conn) if data.startswith("P2W_PING:") else None)
+            handled = time.perf_counter()
+            conn.sendall(response)
+            self.trace_request(data, addr[0], accepted, {'accept_to_recv': received - accepted, 'parse': parsed - received,
+                                                         'handle': handled - parsed, 'send': time.perf_counter() - handled})
                 
-                with self.lock:
-                    self.connected_players[username] = time.time()
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] {username} connected from {addr[0]}")
-                conn.send("CONNECTED".encode('utf-8'))
+        except socket.timeout:
+            pass
+        except Exception as e:
+            self.log.emit("error", f"ERROR: {e}", error=str(e))
+        finally:
+            try:
+                conn.close()
+            except:
+                pass
+            if holding_slot:
+                self.connection_semaphore.release()
+    
+    def serve_stream(self, conn, ip, pending):
+        """Persistent connection: answer framed, possibly pipelined commands in order"""
+        decoder = FrameDecoder(self.config['max_frame_bytes'])
+        conn.settimeout(self.config['stream_idle_timeout_seconds'])
+        conn.sendall(encode_frame(STREAM_OK))
+        
+        # The publisher thread writes to this socket too, through the same queue
+        writer = SocketWriter(conn)
+        send = writer.write_all
+        session = StreamSession(writer.write, writer.backlog, conn)
+        try:
+            while True:
+                if not pending:
+                    pending = conn.recv(65536)
+                    if not pending:
+                        return
+                received = time.perf_counter()
+                frames = decoder.feed(pending)
+                pending = b''
+                if frames:
+                    if self.slow_requests.enabled:
+                        self.serve_frames_traced(frames, ip, received, send, session)
+                        continue
+                    responses = [encode_frame(self.answer_frame(frame.strip(), ip, session)) for frame in frames]
+                    send(b''.join(responses))
+        except ProtocolError:
+            pass
+        finally:
+            self.publisher.unsubscribe(session)
+    
+    def serve_frames_traced(self, frames, ip, received, send, session):
+        """Answer a batch of pipelined frames, tracing each one"""
+        parsed = time.perf_counter()
+        responses = []
+        for frame in frames:
+            started = time.perf_counter()
+            responses.append(encode_frame(self.answer_frame(frame.strip(), ip, session)))
+            handled = time.perf_counter()
+            # Traced right away so last_lock_wait still belongs to this frame, send time is shared
+            self.trace_request(frame.strip(), ip, received, {'parse': parsed - received, 'queued': started - parsed,
+                                                             'handle': handled - started})
+        send(b''.join(responses))
+    
+    async def handle_client_async(self, reader, writer):
+        """Event-loop version of handle_client, one coroutine per connection"""
+        ip = writer.get_extra_info('peername')[0]
+        accepted = time.perf_counter()
+        self.active_connections += 1
+        try:
+            if self.active_connections > self.config['async_max_connections']:
                 return
             
-            elif data.startswith("HEARTBEAT:"):
-                username = data.split("HEARTBEAT:", 1)[1].strip()
-                with self.lock:
-                    if username in self.connected_players:
-                        self.connected_players[username] = time.time()
-                conn.send("OK".encode('utf-8'))
+            if ip in self.ip_blacklist:
+                writer.write("BLACKLISTED".encode('utf-8'))
+                await writer.drain()
                 return
             
-            elif data.startswith("DISCONNECT:"):
-                username = data.split("DISCONNECT:", 1)[1].strip()
-                with self.lock:
-                    self.connected_players.pop(username, None)
-                print(f"[{datetime.now().strftime('%H:%M:%S')}] {username} disconnected")
-                conn.send("DISCONNECTED".encode('utf-8'))
+            raw = await asyncio.wait_for(self.read_first_async(reader), timeout=5)
+            received = time.perf_counter()
+            
+            if raw.startswith(STREAM_HELLO_BYTES):
+                self.count_connection()
+                await self.serve_stream_async(reader, writer, ip, raw[len(STREAM_HELLO_BYTES):])
                 return
             
-            elif data.startswith("P2W_PING:"):
-                if self.config['rate_limit_enabled']:
-                    can_ping, wait_time = self.check_rate_limit(addr[0])
-                    if not can_ping:
-                        response = f"RATE_LIMITED:{wait_time:.1f}"
-                        conn.send(response.encode('utf-8'))
-                        return
-                
-                parts = data.split("P2W_PING:", 1)[1].split("|")
-                username = parts[0].strip()
-                
-                if not self.validate_username(username):
-                    conn.send("INVALID_USERNAME".encode('utf-8'))
-                    return
-                
-                try:
-                    latency = float(parts[1]) if len(parts) > 1 else 0
-                except (ValueError, IndexError):
-                    latency = 0
-                
-                with self.lock:
-                    self.ip_last_ping[addr[0]] = time.time()
-                    self.total_pings += 1
-                    
-                    if username in [w['username'] for w in self.winners]:
-                        response = "ALREADY_WON"
-                    else:
-                        rank = len(self.winners) + 1
-                        
-                        winner_data = {
-                            'username': username,
-                            'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                            'ip': addr[0],
-                            'rank': rank,
-                            'latency': f"{latency:.2f}ms"
-                        }
-                        self.winners.append(winner_data)
-                        response = f"WIN:{rank}"
-                        print(f"[{datetime.now().strftime('%H:%M:%S')}] NEW WINNER #{rank}: {username} ({latency:.2f}ms)")
-                
-                # Queue save instead of async thread
-                self.save_winners()
-                conn.send(response.encode('utf-8'))
+            data = raw.decode('utf-8', errors='ignore').strip()
+            
+            if not data:
                 return
             
-            else:
-                conn.send("INVALID_REQUEST".encode('utf-8'))
-                
-        except socket.timeout:
+            self.count_connection()
+            parsed = time.perf_counter()
+            rtt = tcp_rtt(writer.get_extra_info('socket')) if data.startswith("P2W_PING:") else None
+            writer.write(await self.respond_async(data, ip, rtt))
+            handled = time.perf_counter()
+            await writer.drain()
+            self.trace_request(data, ip, accepted, {'accept_to_recv': received - accepted, 'parse': parsed - received,
+                                                    'handle': handled - parsed, 'send': time.perf_counter() - handled})
+            
+        except (asyncio.TimeoutError, ConnectionError):
             pass
         except Exception as e:
-            print(f"[{datetime.now().strftime('%H:%M:%S')}] ERROR: {e}")
+            self.log.emit("error", f"ERROR: {e}", error=str(e))
         finally:
+            self.active_connections -= 1
             try:
-                conn.close()
+                writer.close()
             except:
                 pass
-            self.connection_semaphore.release()
+    
+    async def read_first_async(self, reader):
+        """First bytes of a connection, read on while they are still the start of the stream hello"""
+        raw = await reader.read(1024)
+        while partial_hello(raw):
+            chunk = await reader.read(1024)
+            if not chunk:
+                break
+            raw += chunk
+        return raw
+    
+    async def serve_stream_async(self, reader, writer, ip, pending):
+        decoder = FrameDecoder(self.config['max_frame_bytes'])
+        writer.write(encode_frame(STREAM_OK))
+        await writer.drain()
+        
+        # Pushes come from the publisher thread, the write itself has to happen on the loop
+        loop = asyncio.get_running_loop()
+        session = StreamSession(lambda data: loop.call_soon_threadsafe(writer.write, data),
+                                writer.transport.get_write_buffer_size, writer.get_extra_info('socket'))
+        try:
+            while True:
+                if not pending:
+                    pending = await asyncio.wait_for(reader.read(65536), timeout=self.config['stream_idle_timeout_seconds'])
+                    if not pending:
+                        return
+                received = time.perf_counter()
+                frames = decoder.feed(pending)
+                pending = b''
+                if frames:
+                    if self.slow_requests.enabled and self.config['durability_mode'] == "async":
+                        # Everything runs inline on the loop in this mode, same as the threaded path
+                        self.serve_frames_traced(frames, ip, received, writer.write, session)
+                        await writer.drain()
+                        continue
+                    responses = [encode_frame(await self.answer_frame_async(frame.strip(), ip, session)) for frame in frames]
+                    writer.write(b''.join(responses))
+                    await writer.drain()
+        except ProtocolError:
+            pass
+        finally:
+            self.publisher.unsubscribe(session)
     
     def display_stats(self):
         while True:
             time.sleep(self.config['stats_display_interval'])
-            system("clear||cls")
+            # Only the first few names need a lock, printing happens without one
+            with self.players_lock:
+                online = len(self.connected_players)
+                first_players = list(islice(self.connected_players, 10))
+            
+            # An escape sequence instead of forking a shell to run clear
+            if os.name == 'nt':
+                system("cls")
+            else:
+                print("\033[2J\033[H", end="")
             print(f"\n{'='*60}")
             print(f"P2W Server Stats - {datetime.now().strftime('%H:%M:%S')}")
             print(f"{'='*60}")
-            with self.lock:
-                print(f"Port: {self.port}")
-                print(f"Rate Limiting: {'ENABLED' if self.config['rate_limit_enabled'] else 'DISABLED'}")
-                print(f"Total Winners: {len(self.winners)}")
-                print(f"Players Online: {len(self.connected_players)}")
-                print(f"Total Pings: {self.total_pings}")
-                print(f"Total Connections: {self.total_connections}")
+            print(f"Port: {self.port}")
+            print(f"Rate Limiting: {'ENABLED' if self.config['rate_limit_enabled'] else 'DISABLED'}")
+            print(f"Total Winners: {len(self.winners)}")
+            print(f"Players Online: {online}")
+            print(f"Total Pings: {self.total_pings}")
+            print(f"Total Connections: {self.total_connections}")
+            if self.config['server_mode'] == "asyncio":
+                print(f"Open Connections: {self.active_connections}")
+            elif self.config['server_mode'] == "multiprocess":
+                alive = sum(1 for worker in self.workers if worker.is_alive())
+                print(f"Worker Processes: {alive}/{len(self.workers)}")
+            else:
                 print(f"Active Workers: {self.config['max_connections'] - self.connection_semaphore._value}")
-                uptime = int(time.time() - self.server_start_time)
-                print(f"Uptime: {uptime // 3600}h {(uptime % 3600) // 60}m {uptime % 60}s")
-                if self.connected_players:
-                    players = ', '.join(list(self.connected_players.keys())[:10])
-                    if len(self.connected_players) > 10:
-                        players += f" (+{len(self.connected_players) - 10} more)"
-                    print(f"Online: {players}")
-                print(f"Blacklisted IPs: {len(self.ip_blacklist)}")
+                print(f"Persistent Sessions: {self.config['max_stream_connections'] - self.stream_semaphore._value}")
+            uptime = int(time.time() - self.server_start_time)
+            print(f"Uptime: {uptime // 3600}h {(uptime % 3600) // 60}m {uptime % 60}s")
+            if first_players:
+                players = ', '.join(first_players)
+                if online > 10:
+                    players += f" (+{online - 10} more)"
+                print(f"Online: {players}")
+            print(f"Blacklisted IPs: {len(self.ip_blacklist)}")
+            print(f"Rate Limit Buckets: {len(self.rate_limiter)}")
+            commits = self.commit_count
+            if commits:
+                print(f"Durability: {self.config['durability_mode']} | "
+                      f"Avg Batch: {self.committed_records / commits:.1f} (max {self.max_commit_batch}) | "
+                      f"Fsync: {self.fsync_seconds / commits * 1000:.2f}ms avg, {self.max_fsync_seconds * 1000:.2f}ms max")
+            else:
+                print(f"Durability: {self.config['durability_mode']}")
             print(f"{'='*60}")
             print(f"Edit server_config.json to change settings")
             print(f"{'='*60}\n")
 
+    def log_stats(self):
+        """Headless replacement for display_stats, one structured stats event per interval"""
+        while True:
+            time.sleep(self.config['stats_display_interval'])
+            self.log.emit("stats", "stats", winners=len(self.winners), players_online=len(self.connected_players),
+                          total_pings=self.total_pings, total_connections=self.total_connections,
+                          open_connections=self.active_connections, rate_limit_buckets=len(self.rate_limiter),
+                          journal_commits=self.commit_count, uptime=int(time.time() - self.server_start_time))
+    
+    def print_startup_info(self):
+        if self.headless:
+            self.log.emit("startup", "startup", port=self.port, server_mode=self.config['server_mode'],
+                          rate_limit_enabled=self.config['rate_limit_enabled'],
+                          durability_mode=self.config['durability_mode'], metrics_url=self.metrics_url)
+            return
+        print(f"P2W Server started on port {self.port}")
+        print(f"Server mode: {self.config['server_mode']}")
+        if self.config['server_mode'] == "asyncio":
+            print(f"Max concurrent connections: {self.config['async_max_connections']}")
+        elif self.config['server_mode'] == "multiprocess":
+            print(f"Worker processes: {self.config['worker_processes']} ({self.config['worker_server_mode']})")
+        else:
+            print(f"Max concurrent requests: {self.config['max_connections']}")
+            print(f"Max persistent sessions: {self.config['max_stream_connections']}")
+        print(f"Rate limiting: {'ENABLED' if self.config['rate_limit_enabled'] else 'DISABLED'}")
+        if self.config['rate_limit_enabled']:
+            print(f"Rate limit: 1 ping per {self.config['rate_limit_seconds']} seconds (burst {self.config['rate_limit_burst']})")
+            print(f"Subnet limit: 1 ping per {self.config['subnet_rate_limit_seconds']} seconds (burst {self.config['subnet_rate_limit_burst']})")
+        print(f"Protocol: one-shot requests + persistent pipelined connections")
+        print(f"Security: Username validation, IP blacklist")
+        if self.metrics_url:
+            print(f"Metrics: {self.metrics_url}")
+        print(f"\nEdit server_config.json to change settings\n")
+    
     def start(self):
+        # kill -USR2 <pid> toggles the sampling profiler without an admin connection
+        if hasattr(signal, "SIGUSR2"):
+            signal.signal(signal.SIGUSR2, self.toggle_profiler)
+        if self.config['server_mode'] == "multiprocess":
+            self.start_multiprocess()
+        elif self.config['server_mode'] == "asyncio":
+            self.start_async()
+        else:
+            self.start_threaded()
+    
+    def shutdown(self):
+        self.log.emit("shutdown", "Server shutting down...")
+        self.flush_journal(force_fsync=True)
+        self.backup_data()
+        self.log.flush()
+    
+    def create_listen_socket(self):
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
         server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
-        
+        server.bind(('0.0.0.0', self.port))
+        return server
+    
+    def start_threaded(self):
+        server = None
         try:
-            server.bind(('0.0.0.0', self.port))
+            server = self.create_listen_socket()
             server.listen(1000)
-            print(f"P2W Server started on port {self.port}")
-            print(f"Max concurrent connections: {self.config['max_connections']}")
-            print(f"Rate limiting: {'ENABLED' if self.config['rate_limit_enabled'] else 'DISABLED'}")
-            if self.config['rate_limit_enabled']:
-                print(f"Rate limit: 1 ping per {self.config['rate_limit_seconds']} seconds")
-            print(f"Security: Username validation, IP blacklist")
-            print(f"\nEdit server_config.json to change settings\n")
+            self.print_startup_info()
 
             while True:
                 try:
                     conn, addr = server.accept()
-                    thread = threading.Thread(target=self.handle_client, args=(conn, addr))
+                    thread = threading.Thread(target=self.handle_client, args=(conn, addr, time.perf_counter()))
                     thread.daemon = True
                     thread.start()
                 except Exception as e:
-                    print(f"Accept error: {e}")
+                    self.log.emit("error", f"Accept error: {e}", error=str(e))
                     
         except KeyboardInterrupt:
-            print("\nServer shutting down...")
-            self.backup_data()
+            self.shutdown()
         finally:
-            server.close()
+            if server:
+                server.close()
+    
+    def raise_fd_limit(self):
+        """Every open socket is a file descriptor, so lift the soft limit to the hard limit"""
+        try:
+            import resource
+        except ImportError:
+            return  # Windows has no fd rlimit
+        try:
+            soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+            if hard == resource.RLIM_INFINITY:
+                hard = self.config['async_max_connections'] + 1024
+            if soft < hard:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError) as e:
+            self.log.emit("fd_limit_error", f"Could not raise open file limit: {e}", error=str(e))
+    
+    async def serve_async(self):
+        # Wins waiting for a group commit each hold an executor thread
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=self.config['coordinator_threads']))
+        server = self.create_listen_socket()
+        async_server = await asyncio.start_server(self.handle_client_async, sock=server, backlog=4096)
+        self.print_startup_info()
+        async with async_server:
+            await async_server.serve_forever()
+    
+    def start_async(self):
+        """Serve every connection from a single asyncio event loop instead of one thread each"""
+        self.raise_fd_limit()
+        try:
+            asyncio.run(self.serve_async())
+        except KeyboardInterrupt:
+            self.shutdown()
+    
+    def start_multiprocess(self):
+        """Run N worker processes on the same port, this process owns all shared state"""
+        if not hasattr(socket, "SO_REUSEPORT"):
+            self.log.emit("mode_fallback", "SO_REUSEPORT is not available on this platform, falling back to threaded mode",
+                          server_mode="threaded")
+            self.config['server_mode'] = "threaded"
+            self.start_threaded()
+            return
+        
+        self.executor = ThreadPoolExecutor(max_workers=self.config['coordinator_threads'])
+        context = multiprocessing.get_context("spawn")
+        self.workers = [None] * self.config['worker_processes']
+        self.print_startup_info()
+        
+        try:
+            while True:
+                for worker_id, worker in enumerate(self.workers):
+                    if worker is None or not worker.is_alive():
+                        if worker is not None:
+                            self.log.emit("worker_restart", f"Worker {worker_id} exited, restarting", worker=worker_id)
+                        self.workers[worker_id] = self.spawn_worker(context, worker_id)
+                time.sleep(1)
+        except KeyboardInterrupt:
+            for worker in self.workers:
+                if worker is not None:
+                    worker.terminate()
+            self.shutdown()
+    
+    def spawn_worker(self, context, worker_id):
+        parent_channel, child_channel = context.Pipe()
+        worker_config = dict(self.config, server_mode=self.config['worker_server_mode'])
+        process = context.Process(
+            target=run_worker,
+            args=(self.port, worker_id, worker_config, self.ip_blacklist, child_channel, self.headless),
+            daemon=True
+        )
+        process.start()
+        child_channel.close()
+        threading.Thread(target=self.serve_worker, args=(parent_channel,), daemon=True).start()
+        return process
+    
+    def serve_worker(self, channel):
+        """Answer commands forwarded by one worker process"""
+        send_lock = threading.Lock()
+        
+        def handle(request_id, data, ip, rtt, queued):
+            try:
+                started = time.perf_counter()
+                response = self.respond(data, ip, rtt)
+                # Socket phases happen in the worker, the coordinator sees queueing and handling
+                self.trace_request(data, ip, queued, {'queued': started - queued, 'handle': time.perf_counter() - started})
+            except Exception as e:
+                self.log.emit("error", f"ERROR: {e}", error=str(e))
+                response = b"INVALID_REQUEST"
+            with send_lock:
+                channel.send((request_id, response))
+        
+        try:
+            while True:
+                request_id, data, ip, rtt, new_connections = channel.recv()
+                if new_connections:
+                    with self.counters_lock:
+                        self.total_connections += new_connections
+                self.executor.submit(handle, request_id, data, ip, rtt, time.perf_counter())
+        except (EOFError, OSError):
+            pass
+
+
+class P2WWorker(P2WServer):
+    """Accepts, parses and answers connections, shared state lives in the coordinator process"""
+    
+    def __init__(self, port, worker_id, config, blacklist, channel, headless=False):
+        self.port = port
+        self.worker_id = worker_id
+        self.headless = headless
+        self.config = config
+        self.log = self.create_log()
+        threading.Thread(target=self.log.run, daemon=True).start()
+        self.ip_blacklist = blacklist
+        self.channel = channel
+        self.channel_lock = threading.Lock()
+        self.pending = {}
+        self.request_ids = count()
+        self.unreported_connections = 0
+        self.connection_semaphore = threading.Semaphore(config['max_connections'])
+        self.stream_semaphore = threading.Semaphore(config['max_stream_connections'])
+        self.active_connections = 0
+        # Admin commands are forwarded, so tracing and profiling by command happen in the
+        # coordinator. SIGUSR2 sent to a worker's pid still profiles that worker
+        self.slow_requests = SlowRequestLog(enabled=False)
+        self.profiler = SamplingProfiler(config['profile_interval_ms'] / 1000)
+        # Subscribers are served from here, one forwarded read per tick covers all of them
+        self.publisher = self.create_publisher()
+        threading.Thread(target=self.read_channel, daemon=True).start()
+    
+    def create_listen_socket(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Every worker binds the same port, the kernel spreads connections between them
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        server.bind(('0.0.0.0', self.port))
+        return server
+    
+    def print_startup_info(self):
+        pass
+    
+    def shutdown(self):
+        pass
+    
+    def count_connection(self):
+        # Reported to the coordinator with the next forwarded command
+        self.unreported_connections += 1
+    
+    def forward(self, data, ip, on_response, rtt=None):
+        request_id = next(self.request_ids)
+        self.pending[request_id] = on_response
+        with self.channel_lock:
+            new_connections = self.unreported_connections
+            self.unreported_connections = 0
+            # The connection lives here, so the RTT measured on it travels with the command
+            self.channel.send((request_id, data, ip, rtt, new_connections))
+        return request_id
+    
+    def read_channel(self):
+        try:
+            while True:
+                request_id, response = self.channel.recv()
+                on_response = self.pending.pop(request_id, None)
+                if on_response:
+                    on_response(response)
+        except (EOFError, OSError):
+            # Coordinator is gone, nothing left to serve
+            os._exit(1)
+    
+    def respond(self, data, ip, rtt=None):
+        done = threading.Event()
+        result = []
+        
+        def on_response(response):
+            result.append(response)
+            done.set()
+        
+        request_id = self.forward(data, ip, on_response, rtt)
+        if not done.wait(self.config['worker_reply_timeout_seconds']):
+            return self.reply_timed_out(request_id, data)
+        return result[0]
+    
+    async def respond_async(self, data, ip, rtt=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        
+        def deliver(response):
+            if not future.done():
+                future.set_result(response)
+        
+        def on_response(response):
+            loop.call_soon_threadsafe(deliver, response)
+        
+        request_id = self.forward(data, ip, on_response, rtt)
+        try:
+            return await asyncio.wait_for(future, self.config['worker_reply_timeout_seconds'])
+        except asyncio.TimeoutError:
+            return self.reply_timed_out(request_id, data)
+    
+    def reply_timed_out(self, request_id, data):
+        """The coordinator didn't answer in time, a late reply is dropped"""
+        self.pending.pop(request_id, None)
+        self.log.emit("reply_timeout", f"WARNING: No reply from the coordinator for {data.split(':', 1)[0]}",
+                      command=data.split(':', 1)[0], worker=self.worker_id)
+        return b"TIMEOUT"
+
+
+def run_worker(port, worker_id, config, blacklist, channel, headless):
+    """Entry point of a worker process"""
+    P2WWorker(port, worker_id, config, blacklist, channel, headless).start()
+
+def convert_snapshot(source, target, to_binary):
+    """Convert a JSON winners snapshot to binary, or back"""
+    if not to_binary:
+        winners, total_pings = WinnerStore.load_binary(source, map_file=False)
+    else:
+        with open(source, 'r') as f:
+            data = json.load(f)
+        winners = WinnerStore()
+        winners.extend_legacy(data.get('winners', []))
+        total_pings = data.get('total_pings', 0)
+    
+    if to_binary:
+        with open(target, 'wb') as f:
+            winners.write_binary(f, winners.capture_indexes(), total_pings)
+    else:
+        with open(target, 'w') as f:
+            winners.write_json(f, len(winners), total_pings)
+    print(f"Converted {len(winners)} winners: {source} -> {target}")
+
 
 if __name__ == "__main__":
-    print("=== P2W (Ping 2 Win) Server ===\n")
+    multiprocessing.freeze_support()
+    
+    parser = argparse.ArgumentParser(description="P2W (Ping 2 Win) Server")
+    parser.add_argument('--to-binary', nargs=2, metavar=('JSON', 'P2WB'), help="convert a JSON snapshot to binary and exit")
+    parser.add_argument('--to-json', nargs=2, metavar=('P2WB', 'JSON'), help="convert a binary snapshot to JSON and exit")
+    parser.add_argument('--restore', type=int, metavar='PORT', help="rebuild the winners of PORT from its backups and exit")
+    parser.add_argument('--until', type=int, metavar='TIMESTAMP', help="with --restore, use the newest backup at or before this unix time")
+    parser.add_argument('--headless', action='store_true', help="no prompt or stats screen, log JSON lines instead")
+    parser.add_argument('--port', type=int, help="port to listen on (skips the prompt)")
+    parser.add_argument('--mode', choices=("threaded", "asyncio", "multiprocess"), help="override server_mode from the config")
+    args = parser.parse_args()
+    if args.to_binary or args.to_json:
+        convert_snapshot(*(args.to_binary or args.to_json), to_binary=bool(args.to_binary))
+        sys.exit(0)
+    if args.restore:
+        server = P2WServer(args.restore, start_threads=False, headless=args.headless)
+        restored = server.restore_backup(args.until)
+        server.log.flush()
+        sys.exit(0 if restored else 1)
     
-    port = input("Enter port (default 5555): ").strip()
-    port = int(port) if port else 5555
+    if args.port:
+        port = args.port
+    elif args.headless:
+        port = 5555
+    else:
+        print("=== P2W (Ping 2 Win) Server ===\n")
+        port = input("Enter port (default 5555): ").strip()
+        port = int(port) if port else 5555
     
-    server = P2WServer(port)
+    server = P2WServer(port, headless=args.headless)
+    if args.mode:
+        server.config['server_mode'] = args.mode
     server.start()
\ No newline at end of file
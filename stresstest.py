@@ -3,6 +3,210 @@ import threading
 import time
 import random
 import string
+import json
+import asyncio
+import argparse
+import sys
+import multiprocessing
+from protocol import StreamConnection, FrameDecoder, ProtocolError, encode_frame, STREAM_HELLO_BYTES, STREAM_OK
+
+# How long distributed workers wait for each other before giving up
+BARRIER_TIMEOUT = 60
+
+# Default command mix for the contention and open-loop tests
+DEFAULT_MIX = {"HEARTBEAT": 0.5, "GET_STATS": 0.25, "GET_LEADERBOARD": 0.2, "P2W_PING": 0.05}
+
+# Player group defaults for scenario files, intervals match client.py
+PLAYER_DEFAULTS = {
+    "name": "players",
+    "count": 100,
+    "heartbeat_interval": 15,       # send_heartbeat
+    "stats_interval": 3,            # update_stats
+    "leaderboard_interval": 120,    # mean seconds between leaderboard opens, 0 for never
+    "leaderboard_pages": 1,         # pages scrolled per open (fetch_leaderboard_page)
+    "page_size": 100,
+    "ping_probability": 1.0,        # chance the player pings during its session
+    "ping_after": [5, 30],          # seconds after connecting
+    "session": None                 # [min, max] seconds connected, default the whole run
+}
+
+
+def load_scenario(path):
+    """Read a scenario file and fill in defaults"""
+    with open(path, 'r') as f:
+        scenario = json.load(f)
+    if not scenario.get('players'):
+        raise ValueError(f"{path}: scenario needs at least one entry in \"players\"")
+    scenario.setdefault('name', path)
+    scenario.setdefault('duration', 60)
+    scenario.setdefault('ramp_up', 0)
+    scenario.setdefault('connections', "oneshot")
+    if scenario['connections'] not in ("oneshot", "persistent"):
+        raise ValueError(f"{path}: connections must be \"oneshot\" or \"persistent\"")
+    scenario['players'] = [dict(PLAYER_DEFAULTS, **group) for group in scenario['players']]
+    return scenario
+
+
+class LatencyHistogram:
+    """HDR-style histogram of latencies in microseconds, about 1.5% relative precision.
+    
+    Values below 128us get their own bucket, above that every power of two is
+    split into 64 buckets, so memory stays small however long the test runs.
+    """
+    
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.sum = 0
+        self.max = 0
+    
+    @staticmethod
+    def bucket(value):
+        if value < 128:
+            return value
+        shift = value.bit_length() - 7
+        return (shift << 6) + (value >> shift)
+    
+    @staticmethod
+    def bucket_value(index):
+        """Highest value that lands in bucket index"""
+        if index < 128:
+            return index
+        shift = (index >> 6) - 1
+        return ((index - (shift << 6) + 1) << shift) - 1
+    
+    def record(self, seconds):
+        value = max(0, int(seconds * 1000000))
+        index = self.bucket(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+    
+    def merge(self, other):
+        for index, n in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + n
+        self.total += other.total
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+    
+    def percentile(self, p):
+        """Latency in milliseconds at or below which p percent of samples fall"""
+        if not self.total:
+            return 0.0
+        target = max(1, int(self.total * p / 100 + 0.5))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.bucket_value(index), self.max) / 1000
+        return self.max / 1000
+    
+    def mean(self):
+        return self.sum / self.total / 1000 if self.total else 0.0
+    
+    def to_dict(self):
+        return {'counts': {str(k): v for k, v in self.counts.items()}, 'total': self.total, 'sum': self.sum, 'max': self.max}
+    
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.counts = {int(k): v for k, v in data['counts'].items()}
+        histogram.total = data['total']
+        histogram.sum = data['sum']
+        histogram.max = data['max']
+        return histogram
+
+
+class AsyncStreamPool:
+    """Persistent connections for the open-loop test, replies are matched to requests in order"""
+    
+    def __init__(self, host, port, size, source_ip=None):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.local_addr = (source_ip, 0) if source_ip else None
+        self.connections = []
+        self.next = 0
+    
+    async def connect(self, timeout=10):
+        try:
+            await asyncio.wait_for(self.open_connections(), timeout)
+        except asyncio.TimeoutError:
+            self.close()
+            raise ConnectionError(f"no STREAM_OK from {self.host}:{self.port} within {timeout}s")
+    
+    async def open_connections(self):
+        greetings = []
+        for _ in range(self.size):
+            reader, writer = await asyncio.open_connection(self.host, self.port, local_addr=self.local_addr)
+            connection = {'writer': writer, 'waiting': [], 'decoder': FrameDecoder(1 << 24)}
+            self.connections.append(connection)
+            # The first reply is the STREAM_OK greeting, its future is queued before the
+            # reader starts so a greeting that arrives right away still has a taker
+            greetings.append(self.send_on(connection, None))
+            writer.write(STREAM_HELLO_BYTES)
+            connection['reader'] = asyncio.create_task(self.read_replies(reader, connection))
+        for reply in await asyncio.gather(*greetings):
+            if reply != STREAM_OK:
+                raise ConnectionError("server does not support persistent connections")
+    
+    async def read_replies(self, reader, connection):
+        error = ConnectionError("connection closed by server")
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    break
+                for frame in connection['decoder'].feed(chunk):
+                    if not connection['waiting']:
+                        raise ProtocolError("reply without a request")
+                    future = connection['waiting'].pop(0)
+                    if not future.done():
+                        future.set_result(frame)
+        except Exception as e:
+            error = ConnectionError(f"connection failed: {e}")
+        finally:
+            # Whatever ended the reader, nobody may be left waiting on this connection
+            for future in connection['waiting']:
+                if not future.done():
+                    future.set_exception(error)
+            connection['waiting'].clear()
+    
+    def send_on(self, connection, message):
+        future = asyncio.get_running_loop().create_future()
+        connection['waiting'].append(future)
+        if message is not None:
+            connection['writer'].write(encode_frame(message))
+        return future
+    
+    def request(self, message):
+        connection = self.connections[self.next]
+        self.next = (self.next + 1) % len(self.connections)
+        return self.send_on(connection, message)
+    
+    def close(self):
+        for connection in self.connections:
+            if 'reader' in connection:
+                connection['reader'].cancel()
+            connection['writer'].close()
+
+
+def arrival_times(profile, rate, duration, end_rate=None):
+    """Yield intended send times (seconds from start) for an open-loop schedule"""
+    end_rate = rate if end_rate is None else end_rate
+    t = 0.0
+    while True:
+        if profile == "poisson":
+            t += random.expovariate(rate)
+        elif profile == "ramp":
+            # Linear ramp from rate to end_rate, spacing follows the current rate
+            t += 1 / max(rate + (end_rate - rate) * t / duration, 0.001)
+        else:
+            t += 1 / rate
+        if t >= duration:
+            return
+        yield t
 
 class StressTest:
     def __init__(self, server_ip, server_port, num_clients=1000):
@@ -15,13 +219,32 @@ class StressTest:
         self.rate_limited = 0
         self.lock = threading.Lock()
         self.start_time = None
+        self.persistent = False
+        # Local address to connect from, lets one machine look like several players to per-IP limits
+        self.source_ip = None
         
     def generate_username(self):
         """Generate random username"""
         return ''.join(random.choices(string.ascii_letters + string.digits, k=random.randint(5, 15)))
     
+    def get_server_mode(self):
+        """Ask the server which accept loop it is running (threaded/asyncio)"""
+        try:
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.settimeout(3)
+            client.connect((self.server_ip, self.server_port))
+            client.send("GET_STATS".encode('utf-8'))
+            response = client.recv(4096).decode('utf-8')
+            client.close()
+            return json.loads(response).get('server_mode', 'threaded')
+        except:
+            return "unknown"
+    
     def send_ping(self, client_id):
         """Simulate a client pinging the server"""
+        if self.persistent:
+            return self.send_ping_stream(client_id)
+        
         username = f"stress_test_{client_id}"
         
         try:
@@ -90,9 +313,66 @@ class StressTest:
             with self.lock:
                 self.failed += 1
     
+    def send_ping_stream(self, client_id):
+        """Same flow as send_ping, pipelined over one persistent connection"""
+        username = f"stress_test_{client_id}"
+        stream = StreamConnection(self.server_ip, self.server_port, timeout=5)
+        
+        try:
+            stream.connect()
+            response, _ = stream.pipeline([f"CONNECT:{username}", f"HEARTBEAT:{username}"])
+            
+            if response != "CONNECTED":
+                with self.lock:
+                    self.failed += 1
+                return
+            
+            # Small delay to simulate real usage
+            time.sleep(random.uniform(0.01, 0.1))
+            
+            latency = random.uniform(10, 100)
+            response, _ = stream.pipeline([f"P2W_PING:{username}|{latency}", f"DISCONNECT:{username}"])
+            
+            with self.lock:
+                if response.startswith("WIN:") or response == "ALREADY_WON":
+                    self.successful += 1
+                elif response.startswith("RATE_LIMITED:"):
+                    self.rate_limited += 1
+                else:
+                    self.failed += 1
+                    
+        except socket.timeout:
+            with self.lock:
+                self.timeouts += 1
+        except Exception as e:
+            with self.lock:
+                self.failed += 1
+        finally:
+            stream.close()
+    
     def stress_test_connect(self, client_id):
         """Test just connections"""
         username = f"connect_test_{client_id}"
+        if self.persistent:
+            stream = StreamConnection(self.server_ip, self.server_port, timeout=3)
+            try:
+                stream.connect()
+                response, _ = stream.pipeline([f"CONNECT:{username}", f"DISCONNECT:{username}"])
+                with self.lock:
+                    if response == "CONNECTED":
+                        self.successful += 1
+                    else:
+                        self.failed += 1
+            except socket.timeout:
+                with self.lock:
+                    self.timeouts += 1
+            except:
+                with self.lock:
+                    self.failed += 1
+            finally:
+                stream.close()
+            return
+        
         try:
             client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             client.settimeout(3)
@@ -159,7 +439,8 @@ class StressTest:
         """Run full ping test"""
         print(f"\n{'='*60}")
         print(f"FULL STRESS TEST - Simulating {self.num_clients} players")
-        print(f"Server: {self.server_ip}:{self.server_port}")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Connections: {'persistent' if self.persistent else 'one-shot'}")
         print(f"{'='*60}\n")
         
         self.successful = 0
@@ -208,7 +489,8 @@ class StressTest:
         """Test rapid connections"""
         print(f"\n{'='*60}")
         print(f"CONNECTION STRESS TEST - {self.num_clients} connections")
-        print(f"Server: {self.server_ip}:{self.server_port}")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Connections: {'persistent' if self.persistent else 'one-shot'}")
         print(f"{'='*60}\n")
         
         self.successful = 0
@@ -251,7 +533,7 @@ class StressTest:
         """Spam leaderboard requests"""
         print(f"\n{'='*60}")
         print(f"LEADERBOARD STRESS TEST - {num_requests} requests")
-        print(f"Server: {self.server_ip}:{self.server_port}")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
         print(f"{'='*60}\n")
         
         self.successful = 0
@@ -291,7 +573,634 @@ class StressTest:
         print(f"Success Rate: {(self.successful/num_requests)*100:.1f}%")
         print(f"{'='*60}\n")
 
+    def hold_idle_connection(self, sockets):
+        """Open a connection and leave it idle, like a slow or stalled player"""
+        try:
+            client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            client.settimeout(10)
+            client.connect((self.server_ip, self.server_port))
+            with self.lock:
+                sockets.append(client)
+        except:
+            pass
+    
+    def run_hold_test(self, num_idle=2000, num_requests=500):
+        """Hold many idle sockets open, then measure how fast normal requests still get served"""
+        print(f"\n{'='*60}")
+        print(f"IDLE HOLD TEST - {num_idle} idle sockets, {num_requests} requests")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"{'='*60}\n")
+        
+        idle_sockets = []
+        threads = []
+        for i in range(num_idle):
+            t = threading.Thread(target=self.hold_idle_connection, args=(idle_sockets,))
+            threads.append(t)
+            t.start()
+            
+            if i % 200 == 0:
+                time.sleep(0.05)
+        
+        for t in threads:
+            t.join()
+        print(f"Holding {len(idle_sockets)} idle connections")
+        
+        self.successful = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+        self.num_clients = num_requests
+        self.start_time = time.time()
+        self.running = True
+        
+        progress_thread = threading.Thread(target=self.display_progress, daemon=True)
+        progress_thread.start()
+        
+        threads = []
+        for i in range(num_requests):
+            t = threading.Thread(target=self.stress_test_leaderboard)
+            threads.append(t)
+            t.start()
+            
+            if i % 50 == 0:
+                time.sleep(0.05)
+        
+        for t in threads:
+            t.join()
+        
+        self.running = False
+        elapsed = time.time() - self.start_time
+        
+        for client in idle_sockets:
+            try:
+                client.close()
+            except:
+                pass
+        
+        print(f"\n\n{'='*60}")
+        print(f"IDLE HOLD TEST RESULTS")
+        print(f"{'='*60}")
+        print(f"Idle Connections Held: {len(idle_sockets)}")
+        print(f"Total Requests: {num_requests}")
+        print(f"Successful: {self.successful}")
+        print(f"Failed: {self.failed}")
+        print(f"Timeouts: {self.timeouts}")
+        print(f"Time Taken: {elapsed:.2f}s")
+        print(f"Requests/sec: {num_requests/elapsed:.2f}")
+        print(f"Success Rate: {(self.successful/num_requests)*100:.1f}%")
+        print(f"{'='*60}\n")
+
+    def oneshot_request(self, message, timeout=5):
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        try:
+            client.connect((self.server_ip, self.server_port))
+            client.send(message.encode('utf-8'))
+            response = b''
+            while True:
+                chunk = client.recv(65536)
+                if not chunk:
+                    break
+                response += chunk
+            return response.decode('utf-8')
+        finally:
+            client.close()
+    
+    def contention_worker(self, worker_id, deadline, results):
+        """Mixed heartbeat/stats/leaderboard/ping traffic, timing each command type"""
+        username = f"contention_{worker_id}"
+        stream = StreamConnection(self.server_ip, self.server_port, timeout=5)
+        try:
+            stream.connect()
+            send = stream.request
+        except:
+            stream = None
+            send = self.oneshot_request
+        
+        local = {}
+        ping_count = 0
+        try:
+            send(f"CONNECT:{username}")
+            while time.time() < deadline:
+                roll = random.random()
+                if roll < 0.5:
+                    command, message = "HEARTBEAT", f"HEARTBEAT:{username}"
+                elif roll < 0.75:
+                    command, message = "GET_STATS", "GET_STATS"
+                elif roll < 0.95:
+                    command, message = "GET_LEADERBOARD", "GET_LEADERBOARD"
+                else:
+                    ping_count += 1
+                    command, message = "P2W_PING", f"P2W_PING:{username}_{ping_count}|{random.uniform(10, 100)}"
+                
+                start = time.perf_counter()
+                try:
+                    response = send(message)
+                except socket.timeout:
+                    with self.lock:
+                        self.timeouts += 1
+                    continue
+                except:
+                    with self.lock:
+                        self.failed += 1
+                    if stream:
+                        break
+                    continue
+                elapsed = time.perf_counter() - start
+                
+                if command == "P2W_PING" and not (response.startswith("WIN:") or response == "ALREADY_WON"):
+                    # Only pings that got to the winners count, a RATE_LIMITED reply never touched them
+                    with self.lock:
+                        if response.startswith("RATE_LIMITED"):
+                            self.rate_limited += 1
+                        else:
+                            self.failed += 1
+                    continue
+                count, total, worst = local.get(command, (0, 0.0, 0.0))
+                local[command] = (count + 1, total + elapsed, max(worst, elapsed))
+        except:
+            with self.lock:
+                self.failed += 1
+        finally:
+            if stream:
+                stream.close()
+        
+        with self.lock:
+            for command, (count, total, worst) in local.items():
+                agg = results.setdefault(command, [0, 0.0, 0.0])
+                agg[0] += count
+                agg[1] += total
+                agg[2] = max(agg[2], worst)
+                self.successful += count
+    
+    def run_contention_test(self, num_workers=50, duration=10):
+        """Hammer the shared server state with mixed traffic to expose lock contention"""
+        print(f"\n{'='*60}")
+        print(f"LOCK CONTENTION TEST - {num_workers} workers for {duration}s")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Mix: 50% HEARTBEAT, 25% GET_STATS, 20% GET_LEADERBOARD, 5% P2W_PING")
+        print(f"{'='*60}\n")
+        
+        self.successful = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+        self.num_clients = num_workers
+        
+        # Every ping comes from this one address, with rate limiting on nearly all of
+        # them would be answered RATE_LIMITED without ever reaching the winners lock
+        try:
+            previous = self.oneshot_request("ADMIN:RATE_LIMIT_OFF")
+        except OSError:
+            previous = ""
+        if not previous.startswith("OK:"):
+            print("WARNING: Could not switch rate limiting off (admin commands only work from the server's host),")
+            print("         rate limited pings are reported separately\n")
+        
+        self.start_time = time.time()
+        results = {}
+        deadline = time.time() + duration
+        threads = []
+        try:
+            for i in range(num_workers):
+                t = threading.Thread(target=self.contention_worker, args=(i, deadline, results))
+                threads.append(t)
+                t.start()
+            
+            for t in threads:
+                t.join()
+        finally:
+            if previous == "OK:ENABLED":
+                self.oneshot_request("ADMIN:RATE_LIMIT_ON")
+        
+        elapsed = time.time() - self.start_time
+        
+        print(f"{'='*60}")
+        print(f"LOCK CONTENTION TEST RESULTS")
+        print(f"{'='*60}")
+        print(f"{'Command':<18}{'Ops/sec':>10}{'Avg ms':>10}{'Max ms':>10}")
+        for command in ("HEARTBEAT", "GET_STATS", "GET_LEADERBOARD", "P2W_PING"):
+            count, total, worst = results.get(command, (0, 0.0, 0.0))
+            avg = (total / count * 1000) if count else 0
+            print(f"{command:<18}{count / elapsed:>10.1f}{avg:>10.2f}{worst * 1000:>10.2f}")
+        print(f"Total Ops/sec: {self.successful / elapsed:.1f}")
+        print(f"Failed: {self.failed}")
+        print(f"Rate Limited: {self.rate_limited}")
+        print(f"Timeouts: {self.timeouts}")
+        print(f"{'='*60}\n")
+
+    async def open_loop_request(self, message, pool, timeout):
+        if pool:
+            return await asyncio.wait_for(pool.request(message), timeout)
+        
+        async def oneshot():
+            local_addr = (self.source_ip, 0) if self.source_ip else None
+            reader, writer = await asyncio.open_connection(self.server_ip, self.server_port, local_addr=local_addr)
+            try:
+                writer.write(message.encode('utf-8'))
+                return (await reader.read()).decode('utf-8', errors='ignore')
+            finally:
+                writer.close()
+        return await asyncio.wait_for(oneshot(), timeout)
+    
+    async def open_loop_send(self, command, message, intended, pool, timeout, results):
+        try:
+            response = await self.open_loop_request(message, pool, timeout)
+        except asyncio.TimeoutError:
+            results['errors']['timeout'] = results['errors'].get('timeout', 0) + 1
+            return
+        except (OSError, ConnectionError):
+            results['errors']['connection'] = results['errors'].get('connection', 0) + 1
+            return
+        finally:
+            results['outstanding'] -= 1
+        
+        # Measured from when the request was due, not when it went out, so a
+        # stalled server can't hide its queueing delay (coordinated omission)
+        latency = time.perf_counter() - intended
+        if not response or response.startswith(("INVALID", "RATE_LIMITED", "BLACKLISTED")):
+            reason = response.split(":", 1)[0] if response else "empty"
+            results['errors'][reason] = results['errors'].get(reason, 0) + 1
+        results['histograms'].setdefault(command, LatencyHistogram()).record(latency)
+        results['completed'] += 1
+    
+    async def open_loop(self, rate, duration, profile, end_rate, mix, connections, timeout, max_outstanding):
+        pool = None
+        if connections:
+            pool = AsyncStreamPool(self.server_ip, self.server_port, connections, self.source_ip)
+            await pool.connect()
+        
+        commands = list(mix)
+        weights = [mix[command] for command in commands]
+        run_id = ''.join(random.choices(string.ascii_lowercase, k=6))
+        results = {'histograms': {}, 'errors': {}, 'completed': 0, 'scheduled': 0, 'skipped': 0,
+                   'outstanding': 0, 'max_lag': 0.0}
+        tasks = set()
+        start = time.perf_counter()
+        
+        for offset in arrival_times(profile, rate, duration, end_rate):
+            intended = start + offset
+            delay = intended - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                results['max_lag'] = max(results['max_lag'], -delay)
+            
+            results['scheduled'] += 1
+            if results['outstanding'] >= max_outstanding:
+                # The generator itself is saturated, count it instead of queueing more
+                results['skipped'] += 1
+                continue
+            
+            command = random.choices(commands, weights)[0]
+            n = results['scheduled']
+            if command == "P2W_PING":
+                message = f"P2W_PING:ol_{run_id}_{n}|{random.uniform(10, 100):.2f}"
+            elif command in ("HEARTBEAT", "CONNECT", "DISCONNECT"):
+                message = f"{command}:ol_{run_id}_{n % 1000}"
+            else:
+                message = command
+            
+            results['outstanding'] += 1
+            task = asyncio.create_task(self.open_loop_send(command, message, intended, pool, timeout, results))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        
+        send_window = time.perf_counter() - start
+        if tasks:
+            await asyncio.wait(tasks)
+        if pool:
+            pool.close()
+        results['elapsed'] = send_window
+        return results
+    
+    def run_open_loop_test(self, rate=500, duration=10, profile="constant", end_rate=None, mix=None,
+                           connections=0, timeout=5, max_outstanding=10000):
+        """Send requests on a fixed schedule regardless of how fast replies come back.
+        
+        Unlike the thread-per-client tests the offered load doesn't drop when
+        the server slows down, so latency percentiles show where it saturates.
+        """
+        mix = mix or DEFAULT_MIX
+        offered = f"{rate}/s" if profile != "ramp" else f"{rate} -> {end_rate}/s"
+        print(f"\n{'='*60}")
+        print(f"OPEN-LOOP LOAD TEST - {profile} {offered} for {duration}s")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Connections: {f'{connections} persistent' if connections else 'one-shot'}")
+        print(f"Mix: {', '.join(f'{int(w * 100)}% {c}' for c, w in mix.items())}")
+        print(f"{'='*60}\n")
+        
+        results = asyncio.run(self.open_loop(rate, duration, profile, end_rate, mix, connections, timeout, max_outstanding))
+        self.print_open_loop_results(results, duration)
+        return results
+    
+    def print_open_loop_results(self, results, duration, title="OPEN-LOOP TEST RESULTS"):
+        overall = LatencyHistogram()
+        print(f"{'='*60}")
+        print(title)
+        print(f"{'='*60}")
+        print(f"{'Command':<22}{'Count':>8}{'p50':>9}{'p90':>9}{'p99':>9}{'p99.9':>9}{'Max':>9}")
+        for command, histogram in sorted(results['histograms'].items()):
+            overall.merge(histogram)
+            self.print_histogram_row(command, histogram)
+        self.print_histogram_row("ALL", overall)
+        print(f"(latencies in ms, measured from each request's scheduled send time)")
+        print(f"Offered Rate: {results['scheduled'] / duration:.1f} req/s")
+        print(f"Achieved Rate: {results['completed'] / max(results['elapsed'], duration):.1f} req/s")
+        if results['errors']:
+            print(f"Errors: {', '.join(f'{reason} {n}' for reason, n in sorted(results['errors'].items()))}")
+        if results['skipped']:
+            print(f"Skipped (generator saturated): {results['skipped']}")
+        if results['max_lag'] > 0.01:
+            print(f"WARNING: Generator fell up to {results['max_lag'] * 1000:.0f}ms behind schedule")
+        print(f"{'='*60}\n")
+    
+    def print_histogram_row(self, command, histogram):
+        print(f"{command:<22}{histogram.total:>8}" + "".join(
+            f"{value:>9.2f}" for value in (histogram.percentile(50), histogram.percentile(90), histogram.percentile(99),
+                                          histogram.percentile(99.9), histogram.max / 1000)))
+
+    async def scenario_player(self, group, player_id, start_delay, deadline, persistent, run_id, results):
+        """One simulated client: connect, heartbeat, poll stats, open the leaderboard, ping once"""
+        await asyncio.sleep(start_delay)
+        loop = asyncio.get_running_loop()
+        if loop.time() >= deadline:
+            return
+        username = f"sc_{run_id}_{group['name']}_{player_id}"[:32]
+        pool = None
+        if persistent:
+            pool = AsyncStreamPool(self.server_ip, self.server_port, 1, self.source_ip)
+            try:
+                await pool.connect()
+            except (OSError, ConnectionError):
+                results['errors']['connection'] = results['errors'].get('connection', 0) + 1
+                return
+        
+        async def send(command, message, due):
+            results['scheduled'] += 1
+            results['outstanding'] += 1
+            await self.open_loop_send(command, message, due, pool, 5, results)
+        
+        def after(seconds):
+            return loop.time() + seconds if seconds else float('inf')
+        
+        try:
+            now = loop.time()
+            await send("CONNECT", f"CONNECT:{username}", time.perf_counter())
+            end = deadline
+            if group['session']:
+                end = min(end, now + random.uniform(*group['session']))
+            # Spread the periodic timers so players don't fire in lockstep
+            next_heartbeat = now + random.uniform(0, group['heartbeat_interval'])
+            next_stats = now + random.uniform(0, group['stats_interval'])
+            next_leaderboard = after(group['leaderboard_interval'] and random.expovariate(1 / group['leaderboard_interval']))
+            ping_at = now + random.uniform(*group['ping_after']) if random.random() < group['ping_probability'] else float('inf')
+            
+            while True:
+                due = min(next_heartbeat, next_stats, next_leaderboard, ping_at, end)
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if due >= end:
+                    break
+                # perf_counter time the action was due, so a slow reply doesn't hide the next one's delay
+                intended = time.perf_counter() - max(0, loop.time() - due)
+                
+                if due == ping_at:
+                    ping_at = float('inf')
+                    await send("P2W_PING", f"P2W_PING:{username}|{random.uniform(10, 100):.2f}", intended)
+                elif due == next_heartbeat:
+                    next_heartbeat += group['heartbeat_interval']
+                    await send("HEARTBEAT", f"HEARTBEAT:{username}", intended)
+                elif due == next_stats:
+                    next_stats += group['stats_interval']
+                    await send("GET_STATS", "GET_STATS", intended)
+                else:
+                    next_leaderboard = after(random.expovariate(1 / group['leaderboard_interval']))
+                    for page in range(group['leaderboard_pages']):
+                        await send("GET_LEADERBOARD", f"GET_LEADERBOARD:{page * group['page_size']}:{group['page_size']}", intended)
+                    await send("GET_LEADERBOARD_USER", f"GET_LEADERBOARD_USER:{username}", intended)
+            
+            # Players still online at the deadline just stop (and time out on the
+            # server), a simultaneous mass disconnect isn't part of the traffic shape
+            if end < deadline:
+                await send("DISCONNECT", f"DISCONNECT:{username}", time.perf_counter())
+        finally:
+            if pool:
+                pool.close()
+    
+    async def scenario(self, scenario, run_id=None):
+        run_id = run_id or ''.join(random.choices(string.ascii_lowercase, k=4))
+        results = {'histograms': {}, 'errors': {}, 'completed': 0, 'scheduled': 0, 'skipped': 0,
+                   'outstanding': 0, 'max_lag': 0.0}
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        deadline = loop.time() + scenario['duration']
+        persistent = scenario['connections'] == "persistent"
+        
+        players = []
+        for group in scenario['players']:
+            for player_id in range(group['count']):
+                start_delay = random.uniform(0, min(scenario['ramp_up'], scenario['duration']))
+                players.append(self.scenario_player(group, player_id, start_delay, deadline, persistent, run_id, results))
+        await asyncio.gather(*players)
+        results['elapsed'] = time.perf_counter() - start
+        return results
+    
+    def run_scenario(self, scenario):
+        """Replay a population of simulated players described by a scenario file"""
+        groups = ", ".join(f"{group['count']} {group['name']}" for group in scenario['players'])
+        print(f"\n{'='*60}")
+        print(f"SCENARIO - {scenario['name']} for {scenario['duration']}s (ramp-up {scenario['ramp_up']}s)")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Connections: {scenario['connections']}")
+        print(f"Players: {groups}")
+        print(f"{'='*60}\n")
+        
+        print(f"Simulating {sum(group['count'] for group in scenario['players'])} players...")
+        results = asyncio.run(self.scenario(scenario))
+        self.print_open_loop_results(results, scenario['duration'], title=f"SCENARIO RESULTS - {scenario['name']}")
+        return results
+
+
+    def run_distributed(self, kind, params, processes, source_ips=None):
+        """Split an open-loop test or scenario across worker processes and merge their results.
+        
+        One process runs out of GIL and ephemeral ports long before the server
+        saturates. Every worker runs its share of the load (rate or players
+        divided by processes) from its own event loop, optionally connecting
+        from its own source IP, and all start together behind a barrier.
+        """
+        source_ips = source_ips or [None]
+        if kind == "scenario":
+            description = f"scenario {params['name']} for {params['duration']}s"
+            players = sum(group['count'] for group in params['players'])
+            shares = [dict(params, players=[dict(group, count=group['count'] // processes + (i < group['count'] % processes))
+                                            for group in params['players']]) for i in range(processes)]
+            duration = params['duration']
+        else:
+            description = f"open-loop {params['profile']} {params['rate']}/s for {params['duration']}s"
+            shares = [dict(params, rate=params['rate'] / processes,
+                           end_rate=params['end_rate'] / processes if params['end_rate'] else None) for _ in range(processes)]
+            duration = params['duration']
+        
+        print(f"\n{'='*60}")
+        print(f"DISTRIBUTED TEST - {description}")
+        print(f"Server: {self.server_ip}:{self.server_port} ({self.get_server_mode()} mode)")
+        print(f"Workers: {processes} processes" + (f", source IPs {', '.join(source_ips)}" if source_ips[0] else ""))
+        if kind == "scenario":
+            print(f"Players: {players}")
+        print(f"{'='*60}\n")
+        
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(processes, timeout=BARRIER_TIMEOUT)
+        queue = context.Queue()
+        workers = []
+        for i in range(processes):
+            source_ip = source_ips[i % len(source_ips)]
+            worker = context.Process(target=stress_worker, daemon=True,
+                                     args=(i, kind, self.server_ip, self.server_port, source_ip, shares[i], barrier, queue))
+            worker.start()
+            workers.append((worker, source_ip))
+        
+        per_worker = {}
+        failed = {}
+        while len(per_worker) + len(failed) < processes:
+            try:
+                index, data = queue.get(timeout=1)
+            except Exception:
+                if not queue.empty():
+                    continue
+                for i, (worker, _) in enumerate(workers):
+                    if worker.exitcode is not None and i not in per_worker and i not in failed:
+                        failed[i] = f"exited with code {worker.exitcode}"
+                        # The others may still be waiting for it at the barrier
+                        barrier.abort()
+                continue
+            if data is None:
+                failed[index] = "did not start, barrier broken"
+            else:
+                per_worker[index] = load_results(data)
+        for worker, _ in workers:
+            worker.join(timeout=5)
+        
+        print(f"{'Worker':<8}{'Source IP':<16}{'Completed':>10}{'Req/s':>10}{'p99 ms':>10}{'Errors':>10}")
+        for i, (worker, source_ip) in enumerate(workers):
+            results = per_worker.get(i)
+            if results is None:
+                print(f"{i:<8}{source_ip or '-':<16}{'FAILED':>10}  {failed.get(i, 'no results')}")
+                continue
+            overall = LatencyHistogram()
+            for histogram in results['histograms'].values():
+                overall.merge(histogram)
+            print(f"{i:<8}{source_ip or '-':<16}{results['completed']:>10}{results['completed'] / max(results['elapsed'], duration):>10.1f}"
+                  f"{overall.percentile(99):>10.2f}{sum(results['errors'].values()):>10}")
+        print()
+        
+        combined = merge_results(list(per_worker.values()))
+        self.print_open_loop_results(combined, duration, title="DISTRIBUTED TEST RESULTS (all workers)")
+        return combined
+
+
+def stress_worker(index, kind, host, port, source_ip, params, barrier, queue):
+    """Entry point of a distributed stress test worker process"""
+    tester = StressTest(host, port)
+    tester.source_ip = source_ip
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        # Another worker died or never arrived, starting alone would skew the load
+        queue.put((index, None))
+        return
+    if kind == "scenario":
+        results = asyncio.run(tester.scenario(params, run_id=f"{index}{''.join(random.choices(string.ascii_lowercase, k=3))}"))
+    else:
+        results = asyncio.run(tester.open_loop(**params))
+    queue.put((index, dump_results(results)))
+
+
+def merge_results(results_list):
+    """Combine results from several workers, histograms are merged bucket by bucket"""
+    combined = {'histograms': {}, 'errors': {}, 'completed': 0, 'scheduled': 0, 'skipped': 0,
+                'outstanding': 0, 'max_lag': 0.0, 'elapsed': 0.0}
+    for results in results_list:
+        for command, histogram in results['histograms'].items():
+            combined['histograms'].setdefault(command, LatencyHistogram()).merge(histogram)
+        for reason, n in results['errors'].items():
+            combined['errors'][reason] = combined['errors'].get(reason, 0) + n
+        for key in ('completed', 'scheduled', 'skipped'):
+            combined[key] += results[key]
+        combined['max_lag'] = max(combined['max_lag'], results['max_lag'])
+        combined['elapsed'] = max(combined['elapsed'], results['elapsed'])
+    return combined
+
+
+def dump_results(results):
+    return dict(results, histograms={command: h.to_dict() for command, h in results['histograms'].items()})
+
+
+def load_results(data):
+    return dict(data, histograms={command: LatencyHistogram.from_dict(h) for command, h in data['histograms'].items()})
+
+
+def save_results(results, path):
+    """Write a results dict (histograms included) as JSON for later comparison"""
+    with open(path, 'w') as f:
+        json.dump(dump_results(results), f, indent=2)
+    print(f"Results written to {path}")
+
+
+def main(argv):
+    """Non-interactive entry point, returns False when no test was requested on the command line"""
+    parser = argparse.ArgumentParser(description="P2W Server Stress Test Tool")
+    parser.add_argument('--scenario', help="run a scenario file (see scenarios/)")
+    parser.add_argument('--open-loop', action='store_true', help="run the open-loop load test")
+    parser.add_argument('--host', help="server IP (overrides the scenario)")
+    parser.add_argument('--port', type=int, help="server port (overrides the scenario)")
+    parser.add_argument('--duration', type=float, help="run time in seconds (overrides the scenario)")
+    parser.add_argument('--rate', type=float, default=500, help="open-loop requests/sec")
+    parser.add_argument('--end-rate', type=float, help="open-loop ramp target requests/sec")
+    parser.add_argument('--profile', choices=("constant", "ramp", "poisson"), default="constant")
+    parser.add_argument('--connections', type=int, default=0, help="open-loop persistent connections, 0 for one-shot")
+    parser.add_argument('--processes', type=int, default=1, help="split the load across this many worker processes")
+    parser.add_argument('--source-ips', help="comma-separated local IPs, workers connect from them round-robin (e.g. 127.0.0.2,127.0.0.3)")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    args = parser.parse_args(argv)
+    if not (args.scenario or args.open_loop):
+        return False
+    
+    source_ips = args.source_ips.split(",") if args.source_ips else None
+    distributed = args.processes > 1 or source_ips
+    processes = max(args.processes, len(source_ips or []))
+    if args.scenario:
+        scenario = load_scenario(args.scenario)
+        if args.duration:
+            scenario['duration'] = args.duration
+        server = scenario.get('server', {})
+        tester = StressTest(args.host or server.get('host', "localhost"), args.port or server.get('port', 5555))
+        if distributed:
+            results = tester.run_distributed("scenario", scenario, processes, source_ips)
+        else:
+            results = tester.run_scenario(scenario)
+    else:
+        tester = StressTest(args.host or "localhost", args.port or 5555)
+        end_rate = args.end_rate or args.rate * 10
+        if distributed:
+            params = {'rate': args.rate, 'duration': args.duration or 10, 'profile': args.profile, 'end_rate': end_rate,
+                      'mix': DEFAULT_MIX, 'connections': args.connections, 'timeout': 5, 'max_outstanding': 10000}
+            results = tester.run_distributed("open_loop", params, processes, source_ips)
+        else:
+            results = tester.run_open_loop_test(args.rate, args.duration or 10, args.profile, end_rate,
+                                                connections=args.connections)
+    if args.output:
+        save_results(results, args.output)
+    return True
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    if main(sys.argv[1:]):
+        sys.exit(0)
+    
     print("=== P2W Server Stress Test Tool ===\n")
     
     server_ip = input("Server IP (default: localhost): ").strip() or "localhost"
@@ -302,8 +1211,12 @@ if __name__ == "__main__":
     print("2. Connection Test Only")
     print("3. Leaderboard Spam Test")
     print("4. All Tests")
+    print("5. Idle Hold Test (compare threaded vs asyncio server mode)")
+    print("6. Lock Contention Test (mixed heartbeat/stats/leaderboard/ping)")
+    print("7. Open-Loop Load Test (fixed request rate, latency percentiles)")
+    print("8. Scenario File (simulated player population)")
     
-    test_type = input("\nChoice (1-4): ").strip()
+    test_type = input("\nChoice (1-8): ").strip()
     
     if test_type in ['1', '2', '4']:
         num_clients = input("Number of clients (default: 1000): ").strip()
@@ -313,6 +1226,9 @@ if __name__ == "__main__":
     
     tester = StressTest(server_ip, int(server_port), num_clients)
     
+    if test_type in ['1', '2', '4']:
+        tester.persistent = input("Use persistent pipelined connections? (y/N): ").strip().lower() == 'y'
+    
     print("\nStarting stress test in 3 seconds...")
     time.sleep(3)
     
@@ -331,6 +1247,32 @@ if __name__ == "__main__":
         tester.run_full_test()
         time.sleep(2)
         tester.run_leaderboard_test(500)
+    elif test_type == '5':
+        num_idle = input("Number of idle connections (default: 2000): ").strip()
+        num_idle = int(num_idle) if num_idle else 2000
+        tester.run_hold_test(num_idle)
+    elif test_type == '6':
+        num_workers = input("Number of workers (default: 50): ").strip()
+        num_workers = int(num_workers) if num_workers else 50
+        duration = input("Duration in seconds (default: 10): ").strip()
+        duration = int(duration) if duration else 10
+        tester.run_contention_test(num_workers, duration)
+    elif test_type == '7':
+        profile = input("Rate profile - constant, ramp or poisson (default: constant): ").strip() or "constant"
+        rate = input("Requests/sec (default: 500): ").strip()
+        rate = float(rate) if rate else 500
+        end_rate = None
+        if profile == "ramp":
+            end_rate = input(f"Ramp to requests/sec (default: {rate * 10:g}): ").strip()
+            end_rate = float(end_rate) if end_rate else rate * 10
+        duration = input("Duration in seconds (default: 10): ").strip()
+        duration = int(duration) if duration else 10
+        connections = input("Persistent connections, 0 for one-shot (default: 0): ").strip()
+        connections = int(connections) if connections else 0
+        tester.run_open_loop_test(rate, duration, profile, end_rate, connections=connections)
+    elif test_type == '8':
+        scenario_file = input("Scenario file (default: scenarios/production.json): ").strip() or "scenarios/production.json"
+        tester.run_scenario(load_scenario(scenario_file))
     else:
         print("Invalid choice!")
     
@@ -0,0 +1,36 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import P2WServer
+
+PORT = 6101
+
+
+def restart():
+    return P2WServer(PORT, start_threads=False)
+
+
+def test_win_after_torn_record_survives_restart(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    server = restart()
+    assert server.process_command("P2W_PING:alice|1", "10.0.0.1") == "WIN:1"
+    server.flush_journal(force_fsync=True)
+    server.journal.close()
+
+    # Crash in the middle of writing the next record
+    record = json.dumps({'winner': {'username': "bob", 'rank': 2}})
+    with open(server.journal_file, 'a') as f:
+        f.write(record[:len(record) // 2])
+
+    server = restart()
+    assert len(server.winners) == 1
+    assert server.process_command("P2W_PING:carol|1", "10.0.0.2") == "WIN:2"
+    server.flush_journal(force_fsync=True)
+    server.journal.close()
+
+    server = restart()
+    assert server.winners.find("carol")['rank'] == 2
+    assert server.process_command("P2W_PING:dave|1", "10.0.0.3") == "WIN:3"